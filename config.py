@@ -58,6 +58,7 @@ desc += '-celebahq';            dataset = EasyDict(tfrecord_dir='celebahq'); tra
 #desc += '-mnist';               dataset = EasyDict(tfrecord_dir='mnist')
 #desc += '-mnistrgb';            dataset = EasyDict(tfrecord_dir='mnistrgb')
 #desc += '-syn1024rgb';          dataset = EasyDict(class_name='dataset.SyntheticDataset', resolution=1024, num_channels=3)
+#desc += '-celebahq-memmap';     dataset = EasyDict(class_name='dataset.MemmapDataset', tfrecord_dir='celebahq'); train.mirror_augment = True # requires dataset_tool.py create_memmap
 #desc += '-lsun-airplane';       dataset = EasyDict(tfrecord_dir='lsun-airplane-100k');       train.mirror_augment = True
 #desc += '-lsun-bedroom';        dataset = EasyDict(tfrecord_dir='lsun-bedroom-100k');        train.mirror_augment = True
 #desc += '-lsun-bicycle';        dataset = EasyDict(tfrecord_dir='lsun-bicycle-100k');        train.mirror_augment = True
@@ -106,6 +107,19 @@ desc += '-preset-v2-1gpu'; num_gpus = 1; sched.minibatch_base = 4; sched.minibat
 desc += '-fp32'; sched.max_minibatch_per_gpu = {256: 16, 512: 8, 1024: 4}
 #desc += '-fp16'; G.dtype = 'float16'; D.dtype = 'float16'; G.pixelnorm_epsilon=1e-4; G_opt.use_loss_scaling = True; D_opt.use_loss_scaling = True; sched.max_minibatch_per_gpu = {512: 16, 1024: 8}
 
+# Performance options.
+#desc += '-idxshuf'; dataset.shuffle_mode = 'index' # shuffle whole dataset via record index instead of shuffle_mb window
+#desc += '-keepit'; dataset.max_iterators = 3 # keep input pipelines alive across LOD/minibatch changes and warm up the next one in advance
+#desc += '-stage'; train.stage_inputs = True # prefetch minibatches to the GPUs in a background thread
+#desc += '-fuse'; train.fuse_train_ops = True # run the last D step and the G step of each iteration in one session.run()
+#desc += '-cpureals'; train.process_reals_on_cpu = True # fade and adjust reals on the CPU at dataset resolution, transfer as float16
+#desc += '-native'; train.native_resolution = True # train G and D at the resolution of the current phase
+#desc += '-asyncsnap'; train.async_snapshots = True # write network snapshots in a background thread
+#desc += '-chunkedsnap'; train.snapshot_format = 'chunked' # memory-mappable network snapshots that can be loaded one network at a time
+#desc += '-chunkedsnap16'; train.snapshot_format = 'chunked'; train.snapshot_fp16 = True # same, with weights stored as float16
+#desc += '-deltasnap'; train.snapshot_keyframe_interval = 10 # write every 10th network snapshot in full and the rest as compressed deltas
+#desc += '-liveeval'; train.eval_metrics = ['swd', 'fid']; train.eval_ticks = 10; train.eval_gpu = '1' # evaluate metrics during training in a separate process on GPU 1
+
 # Disable individual features.
 #desc += '-nogrowing'; sched.lod_initial_resolution = 1024; sched.lod_training_kimg = 0; sched.lod_transition_kimg = 0; train.total_kimg = 10000
 #desc += '-nopixelnorm'; G.use_pixelnorm = False
@@ -132,9 +146,18 @@ desc += '-fp32'; sched.max_minibatch_per_gpu = {256: 16, 512: 8, 1024: 4}
 #train = EasyDict(func='util_scripts.generate_training_video', run_id=23, duration_sec=20.0); num_gpus = 1; desc = 'training-video-' + str(train.run_id)
 
 #train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-swd-16k.txt', metrics=['swd'], num_images=16384, real_passes=2); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
+#train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-swd-16k-res.txt', metrics=['swd'], num_images=16384, real_passes=2, metric_kwargs={'swd': dict(max_descriptors=2**19, num_threads=4)}); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
 #train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-fid-10k.txt', metrics=['fid'], num_images=10000, real_passes=1); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
 #train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-fid-50k.txt', metrics=['fid'], num_images=50000, real_passes=1); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
 #train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-is-50k.txt', metrics=['is'], num_images=50000, real_passes=1); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
 #train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-msssim-20k.txt', metrics=['msssim'], num_images=20000, real_passes=1); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
+#train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-fid-10k.txt', metrics=['fid'], num_images=10000, real_passes=1, cache_reals=True); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
+#train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-swd-fid-10k.txt', metrics=['swd', 'fid'], num_images=10000, real_passes=1, store_results=True, random_seed=1000); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
+#train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-fid-10k.txt', metrics=['fid'], num_images=10000, real_passes=1, reuse_graph=True); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
+#train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-all-10k.txt', metrics=['swd', 'fid', 'msssim'], num_images=10000, real_passes=1, parallel_feed=True); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
+#train = EasyDict(func='util_scripts.evaluate_metrics', run_id=23, log='metric-fid-10k.txt', metrics=['fid'], num_images=10000, real_passes=1, sharded=True, num_local_workers=3); num_gpus = 1; desc = train.log.split('.')[0] + '-' + str(train.run_id)
+#train = EasyDict(func='inference_server.serve', run_id=23, port=8000, max_batch_size=64, max_latency=0.01); num_gpus = 1; desc = 'inference-server-' + str(train.run_id)
+#train = EasyDict(func='metrics.frechet_inception_distance.benchmark_frechet_distance'); num_gpus = 1; desc = 'benchmark-fid'
+#train = EasyDict(func='metrics.ms_ssim.benchmark_msssim', resolution=256); num_gpus = 1; desc = 'benchmark-msssim'
 
 #----------------------------------------------------------------------------
@@ -7,6 +7,10 @@
 
 import os
 import glob
+import json
+import struct
+import threading
+import collections
 import numpy as np
 import tensorflow as tf
 import tfutil
@@ -28,6 +32,90 @@ def parse_tfrecord_np(record):
     data = ex.features.feature['data'].bytes_list.value[0]
     return np.fromstring(data, np.uint8).reshape(shape)
 
+#----------------------------------------------------------------------------
+# Sidecar index for a collection of tfrecords files, written by
+# TFRecordExporter.close() or "dataset_tool.py create_index". For each file,
+# it records the image shape and the byte offset of every record, which makes
+# it possible to start up without reading the files, to know the number of
+# images, and to access record i directly.
+#
+# Each record is stored as: uint64 length, uint32 masked crc of length,
+# byte data[length], uint32 masked crc of data.
+
+tfrecord_index_suffix = '-rxx.index'
+tfrecord_header_bytes = 12
+tfrecord_footer_bytes = 4
+
+def build_tfrecord_offsets(tfr_file): # => int64 [num_records + 1]
+    offsets = [0]
+    with open(tfr_file, 'rb') as f:
+        while True:
+            header = f.read(tfrecord_header_bytes)
+            if len(header) < tfrecord_header_bytes:
+                break
+            length = struct.unpack('<Q', header[:8])[0]
+            offsets.append(offsets[-1] + tfrecord_header_bytes + length + tfrecord_footer_bytes)
+            f.seek(offsets[-1])
+    return np.int64(offsets)
+
+def save_tfrecord_index(index_file, tfr_files, shapes, offsets):
+    data = dict(version=np.int64(1), files=np.array([os.path.basename(f) for f in tfr_files]), shapes=np.int64(shapes))
+    for idx, offs in enumerate(offsets):
+        data['offsets_%d' % idx] = np.int64(offs)
+    with open(index_file + '.tmp', 'wb') as f:
+        np.savez(f, **data)
+    os.replace(index_file + '.tmp', index_file)
+
+def load_tfrecord_index(tfrecord_dir): # => {tfr_file: (shape, offsets), ...} or None if missing/stale
+    index_files = sorted(glob.glob(os.path.join(tfrecord_dir, '*' + tfrecord_index_suffix)))
+    if len(index_files) != 1:
+        return None
+    with open(index_files[0], 'rb') as f:
+        data = np.load(f)
+        if int(data['version']) != 1:
+            return None
+        index = dict()
+        for idx, (name, shape) in enumerate(zip(data['files'], data['shapes'])):
+            tfr_file = os.path.join(tfrecord_dir, str(name))
+            offsets = data['offsets_%d' % idx]
+            if not os.path.isfile(tfr_file) or os.path.getsize(tfr_file) != offsets[-1]:
+                return None
+            index[tfr_file] = (tuple(int(v) for v in shape), offsets)
+    return index
+
+def read_tfrecord_at(tfr_file, offsets, idx, fd=None): # => serialized record
+    begin = int(offsets[idx]) + tfrecord_header_bytes
+    end = int(offsets[idx + 1]) - tfrecord_footer_bytes
+    if fd is not None and hasattr(os, 'pread'):
+        return os.pread(fd, end - begin, begin) # positional read, safe to issue from several threads at once
+    with open(tfr_file, 'rb') as f:
+        f.seek(begin)
+        return f.read(end - begin)
+
+#----------------------------------------------------------------------------
+# Helpers for locating and loading the labels file of a dataset.
+
+def locate_label_file(dataset_dir, label_file=None):
+    if label_file is None:
+        guess = sorted(glob.glob(os.path.join(dataset_dir, '*.labels')))
+        if len(guess):
+            label_file = guess[0]
+    elif not os.path.isfile(label_file):
+        guess = os.path.join(dataset_dir, label_file)
+        if os.path.isfile(guess):
+            label_file = guess
+    return label_file
+
+def load_labels(label_file, max_label_size, num_unlabeled): # => np_labels
+    assert max_label_size == 'full' or max_label_size >= 0
+    np_labels = np.zeros([num_unlabeled, 0], dtype=np.float32)
+    if label_file is not None and max_label_size != 0:
+        np_labels = np.load(label_file)
+        assert np_labels.ndim == 2
+    if max_label_size != 'full' and np_labels.shape[1] > max_label_size:
+        np_labels = np_labels[:, :max_label_size]
+    return np_labels
+
 #----------------------------------------------------------------------------
 # Dataset class that loads data from tfrecords files.
 
@@ -39,9 +127,11 @@ class TFRecordDataset:
         max_label_size  = 0,        # 0 = no labels, 'full' = full labels, <int> = N first label components.
         repeat          = True,     # Repeat dataset indefinitely.
         shuffle_mb      = 4096,     # Shuffle data within specified window (megabytes), 0 = disable shuffling.
+        shuffle_mode    = 'buffer', # 'buffer' = shuffle records within shuffle_mb window, 'index' = permute record indices each epoch and read records directly.
         prefetch_mb     = 2048,     # Amount of data to prefetch (megabytes), 0 = disable prefetching.
         buffer_mb       = 256,      # Read buffer size (megabytes).
-        num_threads     = 2):       # Number of concurrent threads.
+        num_threads     = 2,        # Number of concurrent threads.
+        max_iterators   = 0):       # Number of (lod, minibatch) iterators to keep alive across configure() calls, 0 = reinitialize on every change.
 
         self.tfrecord_dir       = tfrecord_dir
         self.resolution         = None
@@ -52,37 +142,54 @@ class TFRecordDataset:
         self.label_file         = label_file
         self.label_size         = None      # [component]
         self.label_dtype        = None
+        self.num_images         = None      # Number of images, None = unknown (no index).
         self._np_labels         = None
+        self._tfr_index         = None      # {tfr_file: (shape, offsets), ...}
+        self._tfr_lod_files     = dict()    # lod => tfr_file
+        self._tfr_fds           = dict()    # tfr_file => file descriptor, for shuffle_mode='index'
+        self._tfr_fds_lock      = threading.Lock()
         self._tf_minibatch_in   = None
         self._tf_labels_var     = None
         self._tf_labels_dataset = None
         self._tf_datasets       = dict()
         self._tf_iterator       = None
         self._tf_init_ops       = dict()
+        self._tf_handle_var     = None
+        self._tf_iterators      = collections.OrderedDict() # (lod, minibatch) => dict(handle, get_next, release_op, thread), least recently used first
+        self._max_iterators     = max_iterators
         self._tf_minibatch_np   = None
         self._cur_minibatch     = -1
         self._cur_lod           = -1
 
-        # List tfrecords files and inspect their shapes.
+        # List tfrecords files and inspect their shapes, using the index if available.
         assert os.path.isdir(self.tfrecord_dir)
         tfr_files = sorted(glob.glob(os.path.join(self.tfrecord_dir, '*.tfrecords')))
         assert len(tfr_files) >= 1
-        tfr_shapes = []
-        for tfr_file in tfr_files:
-            tfr_opt = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.NONE)
-            for record in tf.python_io.tf_record_iterator(tfr_file, tfr_opt):
-                tfr_shapes.append(parse_tfrecord_np(record).shape)
-                break
+        self._tfr_index = load_tfrecord_index(self.tfrecord_dir)
+        if self._tfr_index is not None and sorted(self._tfr_index.keys()) == tfr_files:
+            tfr_shapes = [self._tfr_index[tfr_file][0] for tfr_file in tfr_files]
+            counts = set(self._tfr_index[tfr_file][1].size - 1 for tfr_file in tfr_files)
+            assert len(counts) == 1
+            self.num_images = counts.pop()
+        else:
+            self._tfr_index = None
+            tfr_shapes = []
+            for tfr_file in tfr_files:
+                tfr_opt = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.NONE)
+                for record in tf.python_io.tf_record_iterator(tfr_file, tfr_opt):
+                    tfr_shapes.append(parse_tfrecord_np(record).shape)
+                    break
+
+        # Index-based shuffling needs record offsets => scan the record headers if there is no index file.
+        assert shuffle_mode in ['buffer', 'index']
+        if shuffle_mode == 'index' and self._tfr_index is None:
+            self._tfr_index = {tfr_file: (shape, build_tfrecord_offsets(tfr_file)) for tfr_file, shape in zip(tfr_files, tfr_shapes)}
+            counts = set(offsets.size - 1 for shape, offsets in self._tfr_index.values())
+            assert len(counts) == 1
+            self.num_images = counts.pop()
 
         # Autodetect label filename.
-        if self.label_file is None:
-            guess = sorted(glob.glob(os.path.join(self.tfrecord_dir, '*.labels')))
-            if len(guess):
-                self.label_file = guess[0]
-        elif not os.path.isfile(self.label_file):
-            guess = os.path.join(self.tfrecord_dir, self.label_file)
-            if os.path.isfile(guess):
-                self.label_file = guess
+        self.label_file = locate_label_file(self.tfrecord_dir, self.label_file)
 
         # Determine shape and resolution.
         max_shape = max(tfr_shapes, key=lambda shape: np.prod(shape))
@@ -94,15 +201,10 @@ class TFRecordDataset:
         assert all(shape[1] == shape[2] for shape in tfr_shapes)
         assert all(shape[1] == self.resolution // (2**lod) for shape, lod in zip(tfr_shapes, tfr_lods))
         assert all(lod in tfr_lods for lod in range(self.resolution_log2 - 1))
+        self._tfr_lod_files = {lod: tfr_file for tfr_file, lod in zip(tfr_files, tfr_lods) if lod >= 0}
 
         # Load labels.
-        assert max_label_size == 'full' or max_label_size >= 0
-        self._np_labels = np.zeros([1<<20, 0], dtype=np.float32)
-        if self.label_file is not None and max_label_size != 0:
-            self._np_labels = np.load(self.label_file)
-            assert self._np_labels.ndim == 2
-        if max_label_size != 'full' and self._np_labels.shape[1] > max_label_size:
-            self._np_labels = self._np_labels[:, :max_label_size]
+        self._np_labels = load_labels(self.label_file, max_label_size, 1<<20)
         self.label_size = self._np_labels.shape[1]
         self.label_dtype = self._np_labels.dtype.name
 
@@ -116,30 +218,121 @@ class TFRecordDataset:
             for tfr_file, tfr_shape, tfr_lod in zip(tfr_files, tfr_shapes, tfr_lods):
                 if tfr_lod < 0:
                     continue
-                dset = tf.data.TFRecordDataset(tfr_file, compression_type='', buffer_size=buffer_mb<<20)
-                dset = dset.map(parse_tfrecord_tf, num_parallel_calls=num_threads)
-                dset = tf.data.Dataset.zip((dset, self._tf_labels_dataset))
                 bytes_per_item = np.prod(tfr_shape) * np.dtype(self.dtype).itemsize
-                if shuffle_mb > 0:
-                    dset = dset.shuffle(((shuffle_mb << 20) - 1) // bytes_per_item + 1)
+                if shuffle_mode == 'index':
+                    dset = tf.data.Dataset.range(self.num_images)
+                    if shuffle_mb > 0:
+                        dset = dset.shuffle(self.num_images, reshuffle_each_iteration=True) # holds only the indices
+                    dset = dset.map(self._make_index_reader(tfr_file), num_parallel_calls=num_threads)
+                else:
+                    dset = tf.data.TFRecordDataset(tfr_file, compression_type='', buffer_size=buffer_mb<<20)
+                    dset = dset.map(parse_tfrecord_tf, num_parallel_calls=num_threads)
+                    dset = tf.data.Dataset.zip((dset, self._tf_labels_dataset))
+                    if shuffle_mb > 0:
+                        dset = dset.shuffle(((shuffle_mb << 20) - 1) // bytes_per_item + 1)
                 if repeat:
                     dset = dset.repeat()
                 if prefetch_mb > 0:
                     dset = dset.prefetch(((prefetch_mb << 20) - 1) // bytes_per_item + 1)
                 dset = dset.batch(self._tf_minibatch_in)
                 self._tf_datasets[tfr_lod] = dset
-            self._tf_iterator = tf.data.Iterator.from_structure(self._tf_datasets[0].output_types, self._tf_datasets[0].output_shapes)
-            self._tf_init_ops = {lod: self._tf_iterator.make_initializer(dset) for lod, dset in self._tf_datasets.items()}
+            if self._max_iterators > 0:
+                self._tf_handle_var = tf.Variable('', name='iterator_handle', trainable=False)
+                self._tf_iterator = tf.data.Iterator.from_string_handle(self._tf_handle_var, self._tf_datasets[0].output_types, self._tf_datasets[0].output_shapes)
+            else:
+                self._tf_iterator = tf.data.Iterator.from_structure(self._tf_datasets[0].output_types, self._tf_datasets[0].output_shapes)
+                self._tf_init_ops = {lod: self._tf_iterator.make_initializer(dset) for lod, dset in self._tf_datasets.items()}
+
+    # Build a function that reads the record with the given index from tfr_file and returns the parsed image and its label.
+    def _make_index_reader(self, tfr_file):
+        offsets = self._tfr_index[tfr_file][1]
+        def read_func(idx):
+            return read_tfrecord_at(tfr_file, offsets, idx, self._get_tfr_fd(tfr_file))
+        def map_func(idx):
+            record = tf.py_func(read_func, [idx], tf.string, stateful=False)
+            record.set_shape([])
+            return parse_tfrecord_tf(record), tf.gather(self._tf_labels_var, idx)
+        return map_func
+
+    # Get the file descriptor for positional reads from tfr_file, opening it on first use.
+    def _get_tfr_fd(self, tfr_file):
+        with self._tfr_fds_lock:
+            if tfr_file not in self._tfr_fds:
+                self._tfr_fds[tfr_file] = os.open(tfr_file, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            return self._tfr_fds[tfr_file]
+
+    # Close the file descriptors opened by shuffle_mode='index'. They are reopened on demand if the dataset is used again.
+    def close(self):
+        with self._tfr_fds_lock:
+            for fd in self._tfr_fds.values():
+                os.close(fd)
+            self._tfr_fds.clear()
+
+    def __del__(self):
+        if hasattr(self, '_tfr_fds_lock'):
+            self.close()
 
     # Use the given minibatch size and level-of-detail for the data returned by get_minibatch_tf().
     def configure(self, minibatch_size, lod=0):
         lod = int(np.floor(lod))
         assert minibatch_size >= 1 and lod in self._tf_datasets
         if self._cur_minibatch != minibatch_size or self._cur_lod != lod:
-            self._tf_init_ops[lod].run({self._tf_minibatch_in: minibatch_size})
+            if self._max_iterators > 0:
+                it = self._get_iterator(minibatch_size, lod)
+                if it['thread'] is not None:
+                    it['thread'].join()
+                    it['thread'] = None
+                tfutil.set_vars({self._tf_handle_var: it['handle']})
+            else:
+                self._tf_init_ops[lod].run({self._tf_minibatch_in: minibatch_size})
             self._cur_minibatch = minibatch_size
             self._cur_lod = lod
 
+    # Initialize the iterator for the given minibatch size and level-of-detail in advance, and fill its
+    # shuffle and prefetch buffers in a background thread by pulling one minibatch (which is discarded).
+    # A subsequent configure() with the same arguments then switches to it without stalling.
+    # Does nothing unless max_iterators > 0.
+    def warmup(self, minibatch_size, lod=0):
+        lod = int(np.floor(lod))
+        assert minibatch_size >= 1 and lod in self._tf_datasets
+        if self._max_iterators == 0 or (minibatch_size, lod) in self._tf_iterators:
+            return
+        it = self._get_iterator(minibatch_size, lod)
+        sess = tf.get_default_session()
+        it['thread'] = threading.Thread(target=sess.run, args=(it['get_next'],))
+        it['thread'].daemon = True
+        it['thread'].start()
+
+    # Look up or create the persistent iterator for the given minibatch size and level-of-detail.
+    def _get_iterator(self, minibatch_size, lod):
+        key = (lod, minibatch_size)
+        if key in self._tf_iterators:
+            self._tf_iterators.move_to_end(key)
+            return self._tf_iterators[key]
+
+        # Release least recently used iterators, except the current one, to free their buffers.
+        cur_key = (self._cur_lod, self._cur_minibatch)
+        for old_key in list(self._tf_iterators.keys()):
+            if len(self._tf_iterators) < self._max_iterators:
+                break
+            if old_key != cur_key:
+                old = self._tf_iterators.pop(old_key)
+                if old['thread'] is not None:
+                    old['thread'].join()
+                tfutil.run(old['release_op'], {self._tf_minibatch_in: 1})
+
+        # Create new iterator.
+        dset = self._tf_datasets[lod]
+        with tf.name_scope('Dataset'), tf.device('/cpu:0'):
+            iterator = tf.data.Iterator.from_structure(dset.output_types, dset.output_shapes)
+            init_op = iterator.make_initializer(dset)
+            release_op = iterator.make_initializer(dset.take(0))
+            get_next = iterator.get_next()
+        init_op.run({self._tf_minibatch_in: minibatch_size})
+        it = dict(handle=tfutil.run(iterator.string_handle()), get_next=get_next, release_op=release_op, thread=None)
+        self._tf_iterators[key] = it
+        return it
+
     # Get next minibatch as TensorFlow expressions.
     def get_minibatch_tf(self): # => images, labels
         return self._tf_iterator.get_next()
@@ -151,6 +344,14 @@ class TFRecordDataset:
             self._tf_minibatch_np = self.get_minibatch_tf()
         return tfutil.run(self._tf_minibatch_np)
 
+    # Get image and label with the given index as NumPy arrays. Requires the index.
+    def get_record_np(self, idx, lod=0): # => image, label
+        lod = int(np.floor(lod))
+        assert self._tfr_index is not None and 0 <= idx < self.num_images and lod in self._tfr_lod_files
+        tfr_file = self._tfr_lod_files[lod]
+        image = parse_tfrecord_np(read_tfrecord_at(tfr_file, self._tfr_index[tfr_file][1], idx))
+        return image, self._np_labels[idx]
+
     # Get random labels as TensorFlow expression.
     def get_random_labels_tf(self, minibatch_size): # => labels
         if self.label_size > 0:
@@ -165,6 +366,142 @@ class TFRecordDataset:
         else:
             return np.zeros([minibatch_size, 0], self.label_dtype)
 
+#----------------------------------------------------------------------------
+# Dataset class that serves minibatches directly from memory-mapped raw uint8
+# files, one per resolution, as written by "dataset_tool.py create_memmap".
+# There is no protobuf parsing and no shuffle buffer: each minibatch is a
+# random-index gather from the np.memmap of the current LOD.
+
+memmap_header_suffix = '-memmap.json'
+
+class MemmapDataset:
+    def __init__(self,
+        tfrecord_dir,               # Directory containing the memmap header and raw files.
+        resolution      = None,     # Dataset resolution, None = autodetect.
+        label_file      = None,     # Relative path of the labels file, None = autodetect.
+        max_label_size  = 0,        # 0 = no labels, 'full' = full labels, <int> = N first label components.
+        repeat          = True,     # Repeat dataset indefinitely.
+        shuffle_mb      = 4096,     # 0 = sequential order, otherwise = new random permutation for each epoch.
+        **kwargs):                  # Ignore options that only apply to TFRecordDataset.
+
+        self.tfrecord_dir       = tfrecord_dir
+        self.resolution         = None
+        self.resolution_log2    = None
+        self.shape              = []        # [channel, height, width]
+        self.dtype              = 'uint8'
+        self.dynamic_range      = [0, 255]
+        self.label_file         = label_file
+        self.label_size         = None      # [component]
+        self.label_dtype        = None
+        self.num_images         = None
+        self.repeat             = repeat
+        self.shuffle            = (shuffle_mb > 0)
+        self._np_labels         = None
+        self._tf_labels_var     = None
+        self._lod_files         = dict()    # lod => (raw_file, shape)
+        self._memmaps           = dict()    # lod => np.memmap
+        self._order             = None
+        self._order_pos         = 0
+        self._cur_minibatch     = -1
+        self._cur_lod           = -1
+
+        # Parse header.
+        assert os.path.isdir(self.tfrecord_dir)
+        headers = sorted(glob.glob(os.path.join(self.tfrecord_dir, '*' + memmap_header_suffix)))
+        assert len(headers) == 1
+        with open(headers[0], 'rt') as f:
+            header = json.load(f)
+        assert header['version'] == 1 and header['dtype'] == self.dtype
+        self.num_images = header['num_images']
+        shapes = [tuple(lod['shape']) for lod in header['lods']]
+        max_shape = max(shapes, key=lambda shape: np.prod(shape))
+        self.resolution = resolution if resolution is not None else max_shape[1]
+        self.resolution_log2 = int(np.log2(self.resolution))
+        self.shape = [max_shape[0], self.resolution, self.resolution]
+        for lod_info, shape in zip(header['lods'], shapes):
+            assert shape[0] == max_shape[0] and shape[1] == shape[2]
+            lod = self.resolution_log2 - int(np.log2(shape[1]))
+            if lod >= 0:
+                assert shape[1] == self.resolution // (2**lod)
+                self._lod_files[lod] = (os.path.join(self.tfrecord_dir, lod_info['file']), shape)
+        assert all(lod in self._lod_files for lod in range(self.resolution_log2 - 1))
+
+        # Load labels.
+        self.label_file = locate_label_file(self.tfrecord_dir, self.label_file)
+        self._np_labels = load_labels(self.label_file, max_label_size, self.num_images)
+        assert self._np_labels.shape[0] >= self.num_images
+        self.label_size = self._np_labels.shape[1]
+        self.label_dtype = self._np_labels.dtype.name
+        with tf.name_scope('Dataset'), tf.device('/cpu:0'):
+            tf_labels_init = tf.zeros(self._np_labels.shape, self._np_labels.dtype)
+            self._tf_labels_var = tf.Variable(tf_labels_init, name='labels_var')
+            tfutil.set_vars({self._tf_labels_var: self._np_labels})
+
+    # Release resources held by the dataset. The memory maps are released together with the object.
+    def close(self):
+        pass
+
+    # Use the given minibatch size and level-of-detail for the data returned by get_minibatch_tf().
+    def configure(self, minibatch_size, lod=0):
+        lod = int(np.floor(lod))
+        assert minibatch_size >= 1 and lod in self._lod_files
+        if lod not in self._memmaps:
+            raw_file, shape = self._lod_files[lod]
+            self._memmaps[lod] = np.memmap(raw_file, dtype=self.dtype, mode='r', shape=(self.num_images,) + shape)
+        self._cur_minibatch = minibatch_size
+        self._cur_lod = lod
+
+    # Get next minibatch as TensorFlow expressions.
+    def get_minibatch_tf(self): # => images, labels
+        with tf.name_scope('MemmapDataset'), tf.device('/cpu:0'):
+            images, labels = tf.py_func(self._read_minibatch, [], [tf.as_dtype(self.dtype), tf.as_dtype(self.label_dtype)], stateful=True)
+            images.set_shape([None, self.shape[0], None, None])
+            labels.set_shape([None, self.label_size])
+            return images, labels
+
+    # Get next minibatch as NumPy arrays.
+    def get_minibatch_np(self, minibatch_size, lod=0): # => images, labels
+        self.configure(minibatch_size, lod)
+        try:
+            return self._read_minibatch()
+        except StopIteration:
+            raise tf.errors.OutOfRangeError(None, None, 'End of dataset')
+
+    # Get random labels as TensorFlow expression.
+    def get_random_labels_tf(self, minibatch_size): # => labels
+        if self.label_size > 0:
+            return tf.gather(self._tf_labels_var, tf.random_uniform([minibatch_size], 0, self._np_labels.shape[0], dtype=tf.int32))
+        else:
+            return tf.zeros([minibatch_size, 0], self.label_dtype)
+
+    # Get random labels as NumPy array.
+    def get_random_labels_np(self, minibatch_size): # => labels
+        if self.label_size > 0:
+            return self._np_labels[np.random.randint(self._np_labels.shape[0], size=[minibatch_size])]
+        else:
+            return np.zeros([minibatch_size, 0], self.label_dtype)
+
+    # Read the next minibatch from the current LOD. Raises StopIteration at the end of a non-repeating dataset.
+    def _read_minibatch(self): # => images, labels
+        chunks = []
+        remaining = self._cur_minibatch
+        while remaining > 0:
+            if self._order is None or self._order_pos >= self._order.size:
+                if self._order is not None and not self.repeat:
+                    break
+                self._order = np.random.permutation(self.num_images) if self.shuffle else np.arange(self.num_images)
+                self._order_pos = 0
+            chunk = self._order[self._order_pos : self._order_pos + remaining]
+            self._order_pos += chunk.size
+            remaining -= chunk.size
+            chunks.append(chunk)
+        if len(chunks) == 0:
+            raise StopIteration
+        idx = np.concatenate(chunks)
+        if self.shuffle:
+            idx = np.sort(idx) # improve locality of the gather, the minibatch is already random
+        return self._memmaps[self._cur_lod][idx], self._np_labels[idx]
+
 #----------------------------------------------------------------------------
 # Base class for datasets that are generated on the fly.
 
@@ -187,6 +524,9 @@ class SyntheticDataset:
             self._tf_minibatch_var = tf.Variable(np.int32(0), name='minibatch_var')
             self._tf_lod_var = tf.Variable(np.int32(0), name='lod_var')
 
+    def close(self):
+        pass
+
     def configure(self, minibatch_size, lod=0):
         lod = int(np.floor(lod))
         assert minibatch_size >= 1 and lod >= 0 and lod <= self.resolution_log2
@@ -232,6 +572,7 @@ def load_dataset(class_name='dataset.TFRecordDataset', data_dir=None, verbose=Fa
     if verbose:
         print('Streaming data using %s...' % class_name)
     dataset = tfutil.import_obj(class_name)(**adjusted_kwargs)
+    dataset.load_kwargs = dict(kwargs, class_name=class_name) # identifies the configuration, e.g. for caching
     if verbose:
         print('Dataset shape =', np.int32(dataset.shape).tolist())
         print('Dynamic range =', dataset.dynamic_range)
@@ -8,8 +8,12 @@
 import os
 import sys
 import glob
+import json
+import shutil
 import argparse
 import threading
+import multiprocessing
+import collections
 import six.moves.queue as Queue
 import traceback
 import numpy as np
@@ -28,7 +32,7 @@ def error(msg):
 #----------------------------------------------------------------------------
 
 class TFRecordExporter:
-    def __init__(self, tfrecord_dir, expected_images, print_progress=True, progress_interval=10):
+    def __init__(self, tfrecord_dir, expected_images, print_progress=True, progress_interval=10, num_workers=1):
         self.tfrecord_dir       = tfrecord_dir
         self.tfr_prefix         = os.path.join(self.tfrecord_dir, os.path.basename(self.tfrecord_dir))
         self.expected_images    = expected_images
@@ -36,8 +40,11 @@ class TFRecordExporter:
         self.shape              = None
         self.resolution_log2    = None
         self.tfr_writers        = []
+        self.tfr_files          = []
+        self.tfr_offsets        = []    # Byte offset of each record, per writer.
         self.print_progress     = print_progress
         self.progress_interval  = progress_interval
+        self.num_workers        = num_workers
         if self.print_progress:
             print('Creating dataset "%s"' % tfrecord_dir)
         if not os.path.isdir(self.tfrecord_dir):
@@ -50,6 +57,11 @@ class TFRecordExporter:
         for tfr_writer in self.tfr_writers:
             tfr_writer.close()
         self.tfr_writers = []
+        if len(self.tfr_files):
+            shapes = [[self.shape[0], self.shape[1] >> lod, self.shape[2] >> lod] for lod in range(len(self.tfr_files))]
+            dataset.save_tfrecord_index(self.tfr_prefix + dataset.tfrecord_index_suffix, self.tfr_files, shapes, self.tfr_offsets)
+            self.tfr_files = []
+            self.tfr_offsets = []
         if self.print_progress:
             print('%-40s\r' % '', end='', flush=True)
             print('Added %d images.' % self.cur_images)
@@ -60,10 +72,22 @@ class TFRecordExporter:
         return order
 
     def add_image(self, img):
-        if self.print_progress and self.cur_images % self.progress_interval == 0:
-            print('%d / %d\r' % (self.cur_images, self.expected_images), end='', flush=True)
+        self.add_images(img[np.newaxis])
+
+    # Add a batch of images [minibatch, channel, height, width] in one go.
+    def add_images(self, images):
+        self.write_encoded(images.shape[1:], self.encode_images(images))
+
+    # Generate all LODs for a batch of images and serialize them as tf.train.Example records.
+    # Does not touch the writers, so it is safe to call from worker processes.
+    def encode_images(self, images): # => [[record_for_lod, ...], ...]
+        lods = generate_mip_batch(images)
+        return [[serialize_image(lod[idx]) for lod in lods] for idx in range(images.shape[0])]
+
+    # Write the records produced by encode_images().
+    def write_encoded(self, shape, records):
         if self.shape is None:
-            self.shape = img.shape
+            self.shape = shape
             self.resolution_log2 = int(np.log2(self.shape[1]))
             assert self.shape[0] in [1, 3]
             assert self.shape[1] == self.shape[2]
@@ -72,17 +96,60 @@ class TFRecordExporter:
             for lod in range(self.resolution_log2 - 1):
                 tfr_file = self.tfr_prefix + '-r%02d.tfrecords' % (self.resolution_log2 - lod)
                 self.tfr_writers.append(tf.python_io.TFRecordWriter(tfr_file, tfr_opt))
-        assert img.shape == self.shape
-        for lod, tfr_writer in enumerate(self.tfr_writers):
-            if lod:
-                img = img.astype(np.float32)
-                img = (img[:, 0::2, 0::2] + img[:, 0::2, 1::2] + img[:, 1::2, 0::2] + img[:, 1::2, 1::2]) * 0.25
-            quant = np.rint(img).clip(0, 255).astype(np.uint8)
-            ex = tf.train.Example(features=tf.train.Features(feature={
-                'shape': tf.train.Feature(int64_list=tf.train.Int64List(value=quant.shape)),
-                'data': tf.train.Feature(bytes_list=tf.train.BytesList(value=[quant.tostring()]))}))
-            tfr_writer.write(ex.SerializeToString())
-        self.cur_images += 1
+                self.tfr_files.append(tfr_file)
+                self.tfr_offsets.append([0])
+        assert tuple(shape) == tuple(self.shape)
+        for image_records in records:
+            if self.print_progress and self.cur_images % self.progress_interval == 0:
+                print('%d / %d\r' % (self.cur_images, self.expected_images), end='', flush=True)
+            assert len(image_records) == len(self.tfr_writers)
+            for record, tfr_writer, offsets in zip(image_records, self.tfr_writers, self.tfr_offsets):
+                tfr_writer.write(record)
+                offsets.append(offsets[-1] + dataset.tfrecord_header_bytes + len(record) + dataset.tfrecord_footer_bytes)
+            self.cur_images += 1
+
+    # Add images in the order given by item_iterator, running load_func(item) => img
+    # and encode_images() in a pool of num_workers processes. load_func may return
+    # a single image [channel, height, width] or a batch [minibatch, channel, height, width].
+    # The records are written by the calling process in the original order, so the
+    # output is identical to calling add_image() sequentially. Items for which
+    # load_func returns None are skipped. Stops once expected_images have been added.
+    def add_images_concurrently(self, item_iterator, load_func=None, max_items_in_flight=None):
+        if load_func is None: load_func = lambda item: item
+        if self.num_workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            for item in item_iterator:
+                if self.cur_images >= self.expected_images:
+                    break
+                img = load_func(item)
+                if img is not None:
+                    img = img if img.ndim == 4 else img[np.newaxis]
+                    self.add_images(img[:self.expected_images - self.cur_images])
+            return
+
+        if max_items_in_flight is None: max_items_in_flight = self.num_workers * 4
+        assert max_items_in_flight >= 1
+        global _export_worker_state
+        _export_worker_state = (self, load_func) # inherited by the forked workers
+        pool = multiprocessing.get_context('fork').Pool(self.num_workers)
+        try:
+            in_flight = collections.deque()
+            def retire_result():
+                res = in_flight.popleft().get()
+                if res is not None:
+                    shape, records = res
+                    self.write_encoded(shape, records[:self.expected_images - self.cur_images])
+            for item in item_iterator:
+                if self.cur_images >= self.expected_images:
+                    break
+                in_flight.append(pool.apply_async(_export_worker_func, (item,)))
+                while len(in_flight) >= max_items_in_flight:
+                    retire_result()
+            while len(in_flight):
+                retire_result()
+        finally:
+            pool.terminate()
+            pool.join()
+            _export_worker_state = None
 
     def add_labels(self, labels):
         if self.print_progress:
@@ -97,6 +164,55 @@ class TFRecordExporter:
     def __exit__(self, *args):
         self.close()
 
+_export_worker_state = None # (exporter, load_func), set by TFRecordExporter.add_images_concurrently().
+
+def _export_worker_func(item): # => (shape, records) or None
+    exporter, load_func = _export_worker_state
+    img = load_func(item)
+    if img is None:
+        return None
+    img = img if img.ndim == 4 else img[np.newaxis]
+    return img.shape[1:], exporter.encode_images(img)
+
+#----------------------------------------------------------------------------
+# Generate all LODs for a batch of images [minibatch, channel, height, width].
+# Each level is produced by a single 2x2 box filter over the whole batch into a
+# preallocated buffer, and the previous level is then quantized in place. The
+# summation order matches the original per-image code, so the results are
+# bit-identical to filtering the images one at a time.
+
+def generate_mip_batch(images, num_lods=None): # => [uint8_lod0, uint8_lod1, ...]
+    assert images.ndim == 4 and images.dtype == np.uint8
+    n, c, h, w = images.shape
+    if num_lods is None: num_lods = int(np.log2(h)) - 1
+    lods = [images]
+    prev = images
+    for lod in range(1, num_lods):
+        h //= 2; w //= 2
+        cur = np.empty([n, c, h, w], dtype=np.float32)
+        np.add(prev[:, :, 0::2, 0::2], prev[:, :, 0::2, 1::2], out=cur, dtype=np.float32)
+        cur += prev[:, :, 1::2, 0::2]
+        cur += prev[:, :, 1::2, 1::2]
+        cur *= 0.25
+        if prev is not images:
+            lods[-1] = quantize_in_place(prev)
+        lods.append(cur)
+        prev = cur
+    if prev is not images:
+        lods[-1] = quantize_in_place(prev)
+    return lods
+
+def quantize_in_place(x):
+    np.rint(x, out=x)
+    np.clip(x, 0, 255, out=x)
+    return x.astype(np.uint8)
+
+def serialize_image(quant):
+    ex = tf.train.Example(features=tf.train.Features(feature={
+        'shape': tf.train.Feature(int64_list=tf.train.Int64List(value=quant.shape)),
+        'data': tf.train.Feature(bytes_list=tf.train.BytesList(value=[quant.tostring()]))}))
+    return ex.SerializeToString()
+
 #----------------------------------------------------------------------------
 
 class ExceptionInfo(object):
@@ -191,6 +307,7 @@ def display(tfrecord_dir):
     tfutil.init_tf({'gpu_options.allow_growth': True})
     dset = dataset.TFRecordDataset(tfrecord_dir, max_label_size='full', repeat=False, shuffle_mb=0)
     tfutil.init_uninited_vars()
+    total = '%d' % dset.num_images if dset.num_images is not None else '?'
     
     idx = 0
     while True:
@@ -203,7 +320,7 @@ def display(tfrecord_dir):
             import cv2 # pip install opencv-python
             cv2.namedWindow('dataset_tool')
             print('Press SPACE or ENTER to advance, ESC to exit')
-        print('\nidx = %-8d\nlabel = %s' % (idx, labels[0].tolist()))
+        print('\nidx = %d / %s\nlabel = %s' % (idx, total, labels[0].tolist()))
         cv2.imshow('dataset_tool', images[0].transpose(1, 2, 0)[:, :, ::-1]) # CHW => HWC, RGB => BGR
         idx += 1
         if cv2.waitKey() == 27:
@@ -217,6 +334,7 @@ def extract(tfrecord_dir, output_dir):
     tfutil.init_tf({'gpu_options.allow_growth': True})
     dset = dataset.TFRecordDataset(tfrecord_dir, max_label_size=0, repeat=False, shuffle_mb=0)
     tfutil.init_uninited_vars()
+    total = '%d' % dset.num_images if dset.num_images is not None else '?'
     
     print('Extracting images to "%s"' % output_dir)
     if not os.path.isdir(output_dir):
@@ -224,7 +342,7 @@ def extract(tfrecord_dir, output_dir):
     idx = 0
     while True:
         if idx % 10 == 0:
-            print('%d\r' % idx, end='', flush=True)
+            print('%d / %s\r' % (idx, total), end='', flush=True)
         try:
             images, labels = dset.get_minibatch_np(1)
         except tf.errors.OutOfRangeError:
@@ -247,6 +365,9 @@ def compare(tfrecord_dir_a, tfrecord_dir_b, ignore_labels):
     print('Loading dataset "%s"' % tfrecord_dir_b)
     dset_b = dataset.TFRecordDataset(tfrecord_dir_b, max_label_size=max_label_size, repeat=False, shuffle_mb=0)
     tfutil.init_uninited_vars()
+    total = '%d' % max(dset_a.num_images, dset_b.num_images) if dset_a.num_images is not None and dset_b.num_images is not None else '?'
+    if dset_a.num_images is not None and dset_b.num_images is not None and dset_a.num_images != dset_b.num_images:
+        print('Datasets contain different number of images (%d vs. %d)' % (dset_a.num_images, dset_b.num_images))
     
     print('Comparing datasets')
     idx = 0
@@ -254,7 +375,7 @@ def compare(tfrecord_dir_a, tfrecord_dir_b, ignore_labels):
     identical_labels = 0
     while True:
         if idx % 100 == 0:
-            print('%d\r' % idx, end='', flush=True)
+            print('%d / %s\r' % (idx, total), end='', flush=True)
         try:
             images_a, labels_a = dset_a.get_minibatch_np(1)
         except tf.errors.OutOfRangeError:
@@ -282,7 +403,79 @@ def compare(tfrecord_dir_a, tfrecord_dir_b, ignore_labels):
 
 #----------------------------------------------------------------------------
 
-def create_mnist(tfrecord_dir, mnist_dir):
+def create_index(tfrecord_dir):
+    print('Loading dataset "%s"' % tfrecord_dir)
+    tfr_files = sorted(glob.glob(os.path.join(tfrecord_dir, '*.tfrecords')))
+    if len(tfr_files) == 0:
+        error('No tfrecords files found')
+    shapes = []
+    offsets = []
+    tfr_opt = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.NONE)
+    for tfr_file in tfr_files:
+        print('Indexing "%s"' % tfr_file)
+        offsets.append(dataset.build_tfrecord_offsets(tfr_file))
+        for record in tf.python_io.tf_record_iterator(tfr_file, tfr_opt):
+            shapes.append(dataset.parse_tfrecord_np(record).shape)
+            break
+        if len(shapes) != len(offsets) or offsets[-1].size != offsets[0].size:
+            error('All tfrecords files must contain the same, nonzero number of images')
+    prefix = os.path.join(tfrecord_dir, os.path.basename(os.path.normpath(tfrecord_dir)))
+    dataset.save_tfrecord_index(prefix + dataset.tfrecord_index_suffix, tfr_files, shapes, offsets)
+    print('Indexed %d images.' % (offsets[0].size - 1))
+
+#----------------------------------------------------------------------------
+
+def create_memmap(tfrecord_dir, memmap_dir=None):
+    if memmap_dir is None:
+        memmap_dir = tfrecord_dir
+    print('Loading dataset "%s"' % tfrecord_dir)
+    tfr_files = sorted(glob.glob(os.path.join(tfrecord_dir, '*.tfrecords')))
+    if len(tfr_files) == 0:
+        error('No tfrecords files found')
+    if not os.path.isdir(memmap_dir):
+        os.makedirs(memmap_dir)
+    prefix = os.path.join(memmap_dir, os.path.basename(os.path.normpath(memmap_dir)))
+
+    # Write one raw file per resolution.
+    lods = []
+    num_images = None
+    tfr_opt = tf.python_io.TFRecordOptions(tf.python_io.TFRecordCompressionType.NONE)
+    for tfr_file in tfr_files:
+        print('Converting "%s"' % tfr_file)
+        shape = None
+        count = 0
+        raw_file = None
+        with open(prefix + '.tmp', 'wb') as f:
+            for record in tf.python_io.tf_record_iterator(tfr_file, tfr_opt):
+                img = dataset.parse_tfrecord_np(record)
+                if shape is None:
+                    shape = img.shape
+                    raw_file = prefix + '-r%02d.raw' % int(np.log2(shape[1]))
+                assert img.shape == shape and img.dtype == np.uint8
+                f.write(img.tobytes())
+                count += 1
+                if count % 1000 == 0:
+                    print('%d\r' % count, end='', flush=True)
+        if num_images is None:
+            num_images = count
+        if count == 0 or count != num_images:
+            error('All tfrecords files must contain the same, nonzero number of images')
+        os.replace(prefix + '.tmp', raw_file)
+        lods.append(dict(file=os.path.basename(raw_file), shape=list(shape)))
+
+    # Copy labels.
+    label_files = sorted(glob.glob(os.path.join(tfrecord_dir, '*.labels')))
+    if len(label_files) and os.path.abspath(memmap_dir) != os.path.abspath(tfrecord_dir):
+        shutil.copyfile(label_files[0], os.path.join(memmap_dir, os.path.basename(label_files[0])))
+
+    # Write header last, so that it marks a complete dataset.
+    with open(prefix + dataset.memmap_header_suffix, 'wt') as f:
+        json.dump(dict(version=1, num_images=num_images, dtype='uint8', lods=lods), f, indent=2)
+    print('Converted %d images.' % num_images)
+
+#----------------------------------------------------------------------------
+
+def create_mnist(tfrecord_dir, mnist_dir, num_workers=1):
     print('Loading MNIST from "%s"' % mnist_dir)
     import gzip
     with gzip.open(os.path.join(mnist_dir, 'train-images-idx3-ubyte.gz'), 'rb') as file:
@@ -298,15 +491,15 @@ def create_mnist(tfrecord_dir, mnist_dir):
     onehot = np.zeros((labels.size, np.max(labels) + 1), dtype=np.float32)
     onehot[np.arange(labels.size), labels] = 1.0
     
-    with TFRecordExporter(tfrecord_dir, images.shape[0]) as tfr:
+    with TFRecordExporter(tfrecord_dir, images.shape[0], num_workers=num_workers) as tfr:
         order = tfr.choose_shuffled_order()
-        for idx in range(order.size):
-            tfr.add_image(images[order[idx]])
+        blocks = [order[begin : begin + 1000] for begin in range(0, order.size, 1000)]
+        tfr.add_images_concurrently(blocks, load_func=lambda idx: images[idx])
         tfr.add_labels(onehot[order])
 
 #----------------------------------------------------------------------------
 
-def create_mnistrgb(tfrecord_dir, mnist_dir, num_images=1000000, random_seed=123):
+def create_mnistrgb(tfrecord_dir, mnist_dir, num_images=1000000, random_seed=123, num_workers=1):
     print('Loading MNIST from "%s"' % mnist_dir)
     import gzip
     with gzip.open(os.path.join(mnist_dir, 'train-images-idx3-ubyte.gz'), 'rb') as file:
@@ -316,14 +509,14 @@ def create_mnistrgb(tfrecord_dir, mnist_dir, num_images=1000000, random_seed=123
     assert images.shape == (60000, 32, 32) and images.dtype == np.uint8
     assert np.min(images) == 0 and np.max(images) == 255
     
-    with TFRecordExporter(tfrecord_dir, num_images) as tfr:
+    with TFRecordExporter(tfrecord_dir, num_images, num_workers=num_workers) as tfr:
         rnd = np.random.RandomState(random_seed)
-        for idx in range(num_images):
-            tfr.add_image(images[rnd.randint(images.shape[0], size=3)])
+        blocks = (rnd.randint(images.shape[0], size=(min(1000, num_images - begin), 3)) for begin in range(0, num_images, 1000))
+        tfr.add_images_concurrently(blocks, load_func=lambda idx: images[idx])
 
 #----------------------------------------------------------------------------
 
-def create_cifar10(tfrecord_dir, cifar10_dir):
+def create_cifar10(tfrecord_dir, cifar10_dir, num_workers=1):
     print('Loading CIFAR-10 from "%s"' % cifar10_dir)
     import pickle
     images = []
@@ -342,15 +535,15 @@ def create_cifar10(tfrecord_dir, cifar10_dir):
     onehot = np.zeros((labels.size, np.max(labels) + 1), dtype=np.float32)
     onehot[np.arange(labels.size), labels] = 1.0
 
-    with TFRecordExporter(tfrecord_dir, images.shape[0]) as tfr:
+    with TFRecordExporter(tfrecord_dir, images.shape[0], num_workers=num_workers) as tfr:
         order = tfr.choose_shuffled_order()
-        for idx in range(order.size):
-            tfr.add_image(images[order[idx]])
+        blocks = [order[begin : begin + 1000] for begin in range(0, order.size, 1000)]
+        tfr.add_images_concurrently(blocks, load_func=lambda idx: images[idx])
         tfr.add_labels(onehot[order])
 
 #----------------------------------------------------------------------------
 
-def create_cifar100(tfrecord_dir, cifar100_dir):
+def create_cifar100(tfrecord_dir, cifar100_dir, num_workers=1):
     print('Loading CIFAR-100 from "%s"' % cifar100_dir)
     import pickle
     with open(os.path.join(cifar100_dir, 'train'), 'rb') as file:
@@ -364,15 +557,15 @@ def create_cifar100(tfrecord_dir, cifar100_dir):
     onehot = np.zeros((labels.size, np.max(labels) + 1), dtype=np.float32)
     onehot[np.arange(labels.size), labels] = 1.0
 
-    with TFRecordExporter(tfrecord_dir, images.shape[0]) as tfr:
+    with TFRecordExporter(tfrecord_dir, images.shape[0], num_workers=num_workers) as tfr:
         order = tfr.choose_shuffled_order()
-        for idx in range(order.size):
-            tfr.add_image(images[order[idx]])
+        blocks = [order[begin : begin + 1000] for begin in range(0, order.size, 1000)]
+        tfr.add_images_concurrently(blocks, load_func=lambda idx: images[idx])
         tfr.add_labels(onehot[order])
 
 #----------------------------------------------------------------------------
 
-def create_svhn(tfrecord_dir, svhn_dir):
+def create_svhn(tfrecord_dir, svhn_dir, num_workers=1):
     print('Loading SVHN from "%s"' % svhn_dir)
     import pickle
     images = []
@@ -391,15 +584,15 @@ def create_svhn(tfrecord_dir, svhn_dir):
     onehot = np.zeros((labels.size, np.max(labels) + 1), dtype=np.float32)
     onehot[np.arange(labels.size), labels] = 1.0
 
-    with TFRecordExporter(tfrecord_dir, images.shape[0]) as tfr:
+    with TFRecordExporter(tfrecord_dir, images.shape[0], num_workers=num_workers) as tfr:
         order = tfr.choose_shuffled_order()
-        for idx in range(order.size):
-            tfr.add_image(images[order[idx]])
+        blocks = [order[begin : begin + 1000] for begin in range(0, order.size, 1000)]
+        tfr.add_images_concurrently(blocks, load_func=lambda idx: images[idx])
         tfr.add_labels(onehot[order])
 
 #----------------------------------------------------------------------------
 
-def create_lsun(tfrecord_dir, lmdb_dir, resolution=256, max_images=None):
+def create_lsun(tfrecord_dir, lmdb_dir, resolution=256, max_images=None, num_workers=1):
     print('Loading LSUN dataset from "%s"' % lmdb_dir)
     import lmdb # pip install lmdb
     import cv2 # pip install opencv-python
@@ -408,31 +601,30 @@ def create_lsun(tfrecord_dir, lmdb_dir, resolution=256, max_images=None):
         total_images = txn.stat()['entries']
         if max_images is None:
             max_images = total_images
-        with TFRecordExporter(tfrecord_dir, max_images) as tfr:
-            for idx, (key, value) in enumerate(txn.cursor()):
+        def load_func(value):
+            try:
                 try:
-                    try:
-                        img = cv2.imdecode(np.fromstring(value, dtype=np.uint8), 1)
-                        if img is None:
-                            raise IOError('cv2.imdecode failed')
-                        img = img[:, :, ::-1] # BGR => RGB
-                    except IOError:
-                        img = np.asarray(PIL.Image.open(io.BytesIO(value)))
-                    crop = np.min(img.shape[:2])
-                    img = img[(img.shape[0] - crop) // 2 : (img.shape[0] + crop) // 2, (img.shape[1] - crop) // 2 : (img.shape[1] + crop) // 2]
-                    img = PIL.Image.fromarray(img, 'RGB')
-                    img = img.resize((resolution, resolution), PIL.Image.ANTIALIAS)
-                    img = np.asarray(img)
-                    img = img.transpose(2, 0, 1) # HWC => CHW
-                    tfr.add_image(img)
-                except:
-                    print(sys.exc_info()[1])
-                if tfr.cur_images == max_images:
-                    break
+                    img = cv2.imdecode(np.fromstring(value, dtype=np.uint8), 1)
+                    if img is None:
+                        raise IOError('cv2.imdecode failed')
+                    img = img[:, :, ::-1] # BGR => RGB
+                except IOError:
+                    img = np.asarray(PIL.Image.open(io.BytesIO(value)))
+                crop = np.min(img.shape[:2])
+                img = img[(img.shape[0] - crop) // 2 : (img.shape[0] + crop) // 2, (img.shape[1] - crop) // 2 : (img.shape[1] + crop) // 2]
+                img = PIL.Image.fromarray(img, 'RGB')
+                img = img.resize((resolution, resolution), PIL.Image.ANTIALIAS)
+                img = np.asarray(img)
+                return img.transpose(2, 0, 1) # HWC => CHW
+            except:
+                print(sys.exc_info()[1])
+                return None
+        with TFRecordExporter(tfrecord_dir, max_images, num_workers=num_workers) as tfr:
+            tfr.add_images_concurrently((value for key, value in txn.cursor()), load_func=load_func)
         
 #----------------------------------------------------------------------------
 
-def create_celeba(tfrecord_dir, celeba_dir, cx=89, cy=121):
+def create_celeba(tfrecord_dir, celeba_dir, cx=89, cy=121, num_workers=1):
     print('Loading CelebA from "%s"' % celeba_dir)
     glob_pattern = os.path.join(celeba_dir, 'img_align_celeba_png', '*.png')
     image_filenames = sorted(glob.glob(glob_pattern))
@@ -440,18 +632,19 @@ def create_celeba(tfrecord_dir, celeba_dir, cx=89, cy=121):
     if len(image_filenames) != expected_images:
         error('Expected to find %d images' % expected_images)
     
-    with TFRecordExporter(tfrecord_dir, len(image_filenames)) as tfr:
+    def load_func(idx):
+        img = np.asarray(PIL.Image.open(image_filenames[idx]))
+        assert img.shape == (218, 178, 3)
+        img = img[cy - 64 : cy + 64, cx - 64 : cx + 64]
+        return img.transpose(2, 0, 1) # HWC => CHW
+
+    with TFRecordExporter(tfrecord_dir, len(image_filenames), num_workers=num_workers) as tfr:
         order = tfr.choose_shuffled_order()
-        for idx in range(order.size):
-            img = np.asarray(PIL.Image.open(image_filenames[order[idx]]))
-            assert img.shape == (218, 178, 3)
-            img = img[cy - 64 : cy + 64, cx - 64 : cx + 64]
-            img = img.transpose(2, 0, 1) # HWC => CHW
-            tfr.add_image(img)
+        tfr.add_images_concurrently(order, load_func=load_func)
 
 #----------------------------------------------------------------------------
 
-def create_celebahq(tfrecord_dir, celeba_dir, delta_dir, num_threads=4, num_tasks=100):
+def create_celebahq(tfrecord_dir, celeba_dir, delta_dir, num_threads=4, num_tasks=100, num_workers=1):
     print('Loading CelebA from "%s"' % celeba_dir)
     expected_images = 202599
     if len(glob.glob(os.path.join(celeba_dir, 'img_celeba', '*.jpg'))) != expected_images:
@@ -587,15 +780,18 @@ def create_celebahq(tfrecord_dir, celeba_dir, delta_dir, num_threads=4, num_task
         assert md5.hexdigest() == fields['final_md5'][idx]
         return img
 
-    with TFRecordExporter(tfrecord_dir, indices.size) as tfr:
+    with TFRecordExporter(tfrecord_dir, indices.size, num_workers=num_workers) as tfr:
         order = tfr.choose_shuffled_order()
-        with ThreadPool(num_threads) as pool:
-            for img in pool.process_items_concurrently(indices[order].tolist(), process_func=process_func, max_items_in_flight=num_tasks):
-                tfr.add_image(img)
+        if num_workers > 1:
+            tfr.add_images_concurrently(indices[order].tolist(), load_func=process_func, max_items_in_flight=num_tasks)
+        else:
+            with ThreadPool(num_threads) as pool:
+                for img in pool.process_items_concurrently(indices[order].tolist(), process_func=process_func, max_items_in_flight=num_tasks):
+                    tfr.add_image(img)
 
 #----------------------------------------------------------------------------
 
-def create_from_images(tfrecord_dir, image_dir, shuffle):
+def create_from_images(tfrecord_dir, image_dir, shuffle, num_workers=1):
     print('Loading images from "%s"' % image_dir)
     image_filenames = sorted(glob.glob(os.path.join(image_dir, '*')))
     if len(image_filenames) == 0:
@@ -611,27 +807,27 @@ def create_from_images(tfrecord_dir, image_dir, shuffle):
     if channels not in [1, 3]:
         error('Input images must be stored as RGB or grayscale')
     
-    with TFRecordExporter(tfrecord_dir, len(image_filenames)) as tfr:
+    def load_func(idx):
+        img = np.asarray(PIL.Image.open(image_filenames[idx]))
+        if channels == 1:
+            return img[np.newaxis, :, :] # HW => CHW
+        else:
+            return img.transpose(2, 0, 1) # HWC => CHW
+
+    with TFRecordExporter(tfrecord_dir, len(image_filenames), num_workers=num_workers) as tfr:
         order = tfr.choose_shuffled_order() if shuffle else np.arange(len(image_filenames))
-        for idx in range(order.size):
-            img = np.asarray(PIL.Image.open(image_filenames[order[idx]]))
-            if channels == 1:
-                img = img[np.newaxis, :, :] # HW => CHW
-            else:
-                img = img.transpose(2, 0, 1) # HWC => CHW
-            tfr.add_image(img)
+        tfr.add_images_concurrently(order, load_func=load_func)
 
 #----------------------------------------------------------------------------
 
-def create_from_hdf5(tfrecord_dir, hdf5_filename, shuffle):
+def create_from_hdf5(tfrecord_dir, hdf5_filename, shuffle, num_workers=1):
     print('Loading HDF5 archive from "%s"' % hdf5_filename)
     import h5py # conda install h5py
     with h5py.File(hdf5_filename, 'r') as hdf5_file:
         hdf5_data = max([value for key, value in hdf5_file.items() if key.startswith('data')], key=lambda lod: lod.shape[3])
-        with TFRecordExporter(tfrecord_dir, hdf5_data.shape[0]) as tfr:
+        with TFRecordExporter(tfrecord_dir, hdf5_data.shape[0], num_workers=num_workers) as tfr:
             order = tfr.choose_shuffled_order() if shuffle else np.arange(hdf5_data.shape[0])
-            for idx in range(order.size):
-                tfr.add_image(hdf5_data[order[idx]])
+            tfr.add_images_concurrently((hdf5_data[idx] for idx in order)) # h5py handles are not fork-safe => read in the main process
             npy_filename = os.path.splitext(hdf5_filename)[0] + '-labels.npy'
             if os.path.isfile(npy_filename):
                 tfr.add_labels(np.load(npy_filename)[order])
@@ -666,6 +862,15 @@ def execute_cmdline(argv):
     p.add_argument(     'tfrecord_dir_b',   help='Directory containing second dataset')
     p.add_argument(     '--ignore_labels',  help='Ignore labels (default: 0)', type=int, default=0)
 
+    p = add_command(    'create_index',     'Create index for fast startup and random access.',
+                                            'create_index datasets/mnist')
+    p.add_argument(     'tfrecord_dir',     help='Directory containing dataset')
+
+    p = add_command(    'create_memmap',    'Convert dataset to memory-mapped raw format.',
+                                            'create_memmap datasets/mnist')
+    p.add_argument(     'tfrecord_dir',     help='Directory containing dataset')
+    p.add_argument(     '--memmap_dir',     help='Directory to write the raw files into (default: tfrecord_dir)', default=None)
+
     p = add_command(    'create_mnist',     'Create dataset for MNIST.',
                                             'create_mnist datasets/mnist ~/downloads/mnist')
     p.add_argument(     'tfrecord_dir',     help='New dataset directory to be created')
@@ -727,6 +932,10 @@ def execute_cmdline(argv):
     p.add_argument(     'hdf5_filename',    help='HDF5 archive containing the images')
     p.add_argument(     '--shuffle',        help='Randomize image order (default: 1)', type=int, default=1)
 
+    for cmd, p in subparsers.choices.items():
+        if cmd.startswith('create_') and cmd not in ['create_index', 'create_memmap']:
+            p.add_argument( '--num_workers',    help='Number of worker processes for decoding and encoding images (default: 1)', type=int, default=1)
+
     args = parser.parse_args(argv[1:] if len(argv) > 1 else ['-h'])
     func = globals()[args.command]
     del args.command
@@ -0,0 +1,348 @@
+# Copyright (c) 2018, NVIDIA CORPORATION. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial
+# 4.0 International License. To view a copy of this license, visit
+# http://creativecommons.org/licenses/by-nc/4.0/ or send a letter to
+# Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
+
+import os
+import io
+import time
+import json
+import queue
+import threading
+import socketserver
+import http.server
+import urllib.parse
+from collections import OrderedDict, deque
+import numpy as np
+import tensorflow as tf
+
+import config
+import misc
+
+#----------------------------------------------------------------------------
+# Pending request for a batch of generated images.
+
+class InferenceRequest:
+    def __init__(self, latents, labels):
+        self.latents        = latents           # float32 [num, latent_size]
+        self.labels         = labels            # float32 [num, label_size]
+        self.images         = None              # uint8 [num, channels, height, width], set when done.
+        self.error          = None              # Exception raised while generating, if any.
+        self.time_begin     = time.time()       # When the request was submitted.
+        self.time_dispatch  = None              # When the batch containing the request was started.
+        self.done           = threading.Event()
+
+#----------------------------------------------------------------------------
+# Generator that coalesces concurrent requests into dynamically sized batches.
+# A single thread owns the network and runs one batch at a time. A batch is
+# dispatched as soon as it holds max_batch_size images, or when its oldest
+# request has waited for max_latency seconds, whichever comes first.
+# Requests that arrive while a batch is running are picked up immediately
+# by the next one, so batches grow with the load.
+
+class BatchedGenerator:
+    def __init__(self, Gs, max_batch_size=64, max_latency=0.01, num_gpus=1, out_shrink=1, history=10000):
+        assert max_batch_size % num_gpus == 0
+        self.Gs             = Gs
+        self.max_batch_size = max_batch_size
+        self.max_latency    = max_latency
+        self.num_gpus       = num_gpus
+        self.out_shrink     = out_shrink
+        self.graph          = tf.get_default_graph()
+        self.session        = tf.get_default_session()
+        self.latent_shape   = Gs.input_shapes[0][1:]
+        self.label_shape    = Gs.input_shapes[1][1:]
+        self.queue          = queue.Queue()
+        self.pending        = None              # Request that did not fit in the previous batch.
+        self.lock           = threading.Lock()  # Protects the statistics below.
+        self.time_start     = time.time()
+        self.num_requests   = 0
+        self.num_images     = 0
+        self.num_batches    = 0
+        self.num_errors     = 0
+        self.num_in_flight  = 0
+        self.batch_sizes    = deque(maxlen=history)
+        self.latencies      = deque(maxlen=history)
+        self.queue_waits    = deque(maxlen=history)
+
+        # Build the graph and warm up the session before accepting requests.
+        self.image_shape = list(self._run(np.zeros([1] + self.latent_shape, np.float32), np.zeros([1] + self.label_shape, np.float32)).shape[1:])
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+
+    def generate(self, latents, labels=None): # => uint8 [num, channels, height, width]
+        latents = np.asarray(latents, dtype=np.float32)
+        if labels is None:
+            labels = np.zeros([latents.shape[0]] + self.label_shape, np.float32)
+        labels = np.asarray(labels, dtype=np.float32)
+        if latents.ndim != 2 or list(latents.shape[1:]) != self.latent_shape or latents.shape[0] == 0:
+            raise ValueError('Expected latents of shape [N, %s], got %s' % (', '.join(str(x) for x in self.latent_shape), list(latents.shape)))
+        if list(labels.shape) != [latents.shape[0]] + self.label_shape:
+            raise ValueError('Expected labels of shape [%d, %s], got %s' % (latents.shape[0], ', '.join(str(x) for x in self.label_shape), list(labels.shape)))
+        req = InferenceRequest(latents, labels)
+        self.queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.images
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def get_info(self):
+        return OrderedDict(latent_shape=self.latent_shape, label_shape=self.label_shape, image_shape=self.image_shape,
+            max_batch_size=self.max_batch_size, max_latency_ms=self.max_latency * 1000.0, num_gpus=self.num_gpus)
+
+    def get_stats(self):
+        with self.lock:
+            batch_sizes = np.array(self.batch_sizes, np.float64)
+            latencies = np.array(self.latencies, np.float64) * 1000.0
+            queue_waits = np.array(self.queue_waits, np.float64) * 1000.0
+            uptime = time.time() - self.time_start
+            stats = OrderedDict(
+                queue_depth     = self.queue.qsize() + (1 if self.pending is not None else 0),
+                in_flight       = self.num_in_flight,
+                num_requests    = self.num_requests,
+                num_images      = self.num_images,
+                num_batches     = self.num_batches,
+                num_errors      = self.num_errors,
+                uptime_sec      = uptime,
+                images_per_sec  = self.num_images / max(uptime, 1e-8))
+        pct = lambda x, q: float(np.percentile(x, q)) if len(x) else 0.0
+        stats['batch_size_mean']    = float(np.mean(batch_sizes)) if len(batch_sizes) else 0.0
+        stats['batch_size_p50']     = pct(batch_sizes, 50)
+        stats['batch_size_max']     = float(np.max(batch_sizes)) if len(batch_sizes) else 0.0
+        stats['latency_p50_ms']     = pct(latencies, 50)
+        stats['latency_p99_ms']     = pct(latencies, 99)
+        stats['queue_wait_p50_ms']  = pct(queue_waits, 50)
+        stats['queue_wait_p99_ms']  = pct(queue_waits, 99)
+        return stats
+
+    def _run(self, latents, labels):
+        num = latents.shape[0]
+        pad = -num % self.num_gpus # every GPU gets an equal share of the minibatch
+        if pad:
+            latents = np.concatenate([latents, np.zeros([pad] + self.latent_shape, np.float32)])
+            labels = np.concatenate([labels, np.zeros([pad] + self.label_shape, np.float32)])
+        with self.graph.as_default(), self.session.as_default():
+            images = self.Gs.run(latents, labels, minibatch_size=self.max_batch_size, num_gpus=self.num_gpus,
+                out_mul=127.5, out_add=127.5, out_shrink=self.out_shrink, out_dtype=np.uint8)
+        return images[:num]
+
+    def _gather_batch(self): # => [InferenceRequest, ...], None = stop
+        first = self.pending if self.pending is not None else self.queue.get()
+        self.pending = None
+        if first is None:
+            return None
+        reqs = [first]
+        num = first.latents.shape[0]
+        deadline = first.time_begin + self.max_latency
+        while num < self.max_batch_size:
+            try:
+                timeout = deadline - time.time()
+                req = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is None:
+                self.queue.put(None) # stop after this batch
+                break
+            if num + req.latents.shape[0] > self.max_batch_size:
+                self.pending = req
+                break
+            reqs.append(req)
+            num += req.latents.shape[0]
+        return reqs
+
+    def _run_loop(self):
+        while True:
+            reqs = self._gather_batch()
+            if reqs is None:
+                break
+            time_dispatch = time.time()
+            num = sum(req.latents.shape[0] for req in reqs)
+            with self.lock:
+                self.num_in_flight = len(reqs)
+            try:
+                images = self._run(np.concatenate([req.latents for req in reqs]), np.concatenate([req.labels for req in reqs]))
+                begin = 0
+                for req in reqs:
+                    end = begin + req.latents.shape[0]
+                    req.images = images[begin : end]
+                    begin = end
+            except Exception as e:
+                for req in reqs:
+                    req.error = e
+            time_end = time.time()
+            with self.lock:
+                self.num_in_flight = 0
+                self.num_requests += len(reqs)
+                self.num_images += num
+                self.num_batches += 1
+                self.batch_sizes.append(num)
+                for req in reqs:
+                    self.num_errors += int(req.error is not None)
+                    self.latencies.append(time_end - req.time_begin)
+                    self.queue_waits.append(time_dispatch - req.time_begin)
+            for req in reqs:
+                req.time_dispatch = time_dispatch
+                req.done.set()
+
+        # Fail whatever is still queued.
+        while not self.queue.empty():
+            req = self.queue.get_nowait()
+            if req is not None:
+                req.error = RuntimeError('Inference server is shutting down')
+                req.done.set()
+
+#----------------------------------------------------------------------------
+# HTTP front end.
+#
+#   POST /generate          JSON {"latents": [[...], ...]} or {"num": N, "seed": S}, optional "labels" and "format".
+#                           Alternatively a raw float32 latent array with Content-Type: application/octet-stream.
+#                           ?format=png returns a PNG of the image grid (default), ?format=raw returns uint8 NCHW
+#                           bytes with the shape in the X-Image-Shape header.
+#   GET  /metrics           Queue depth, batch sizes and latency percentiles as JSON.
+#   GET  /info              Input and output shapes as JSON.
+
+class InferenceRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/metrics':
+            self._send_json(self.server.generator.get_stats())
+        elif path == '/info':
+            self._send_json(self.server.generator.get_info())
+        else:
+            self._send_error(404, 'Not found: %s' % path)
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/generate':
+            self._send_error(404, 'Not found: %s' % url.path)
+            return
+        try:
+            latents, labels, format = self._parse_request(body, query)
+            images = self.server.generator.generate(latents, labels)
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+        except Exception as e:
+            self._send_error(500, '%s: %s' % (type(e).__name__, e))
+            return
+
+        if format == 'png':
+            buf = io.BytesIO()
+            misc.convert_to_pil_image(misc.create_image_grid(images), [0,255]).save(buf, format='PNG', compress_level=self.server.png_compress_level)
+            self._send(200, buf.getvalue(), 'image/png')
+        else:
+            self._send(200, images.tobytes(), 'application/octet-stream', {'X-Image-Shape': ','.join(str(x) for x in images.shape)})
+
+    def _parse_request(self, body, query): # => latents, labels, format
+        generator = self.server.generator
+        if self.headers.get('Content-Type', '').startswith('application/octet-stream'):
+            latents = np.frombuffer(body, dtype=np.float32)
+            if latents.size == 0 or latents.size % int(np.prod(generator.latent_shape)) != 0:
+                raise ValueError('Raw latents must be a float32 array of shape [N, %s]' % ', '.join(str(x) for x in generator.latent_shape))
+            latents = latents.reshape([-1] + generator.latent_shape)
+            labels = None
+            format = query.get('format', 'png')
+        else:
+            try:
+                req = json.loads(body.decode('utf-8')) if len(body) else dict()
+            except ValueError:
+                raise ValueError('Request body is not valid JSON')
+            if not isinstance(req, dict):
+                raise ValueError('Request body must be a JSON object')
+            try: # malformed values raise TypeError, which would otherwise be reported as an internal error
+                if 'latents' in req:
+                    latents = np.asarray(req['latents'], dtype=np.float32)
+                else:
+                    num = int(req.get('num', 1))
+                    if num < 1 or num > self.server.max_request_images:
+                        raise ValueError('num must be between 1 and %d' % self.server.max_request_images)
+                    seed = req.get('seed', None)
+                    random_state = np.random.RandomState(int(seed)) if seed is not None else np.random.RandomState()
+                    latents = random_state.randn(num, *generator.latent_shape).astype(np.float32)
+                labels = req.get('labels', None)
+                if labels is not None:
+                    labels = np.asarray(labels, dtype=np.float32)
+            except TypeError as e:
+                raise ValueError(str(e))
+            format = query.get('format', req.get('format', 'png'))
+        if format not in ['png', 'raw']:
+            raise ValueError('Unknown format: %s' % format)
+        if latents.ndim != 1 + len(generator.latent_shape):
+            raise ValueError('Expected latents of shape [N, %s], got %s' % (', '.join(str(x) for x in generator.latent_shape), list(latents.shape)))
+        if len(latents) > self.server.max_request_images:
+            raise ValueError('At most %d images per request' % self.server.max_request_images)
+        return latents, labels, format
+
+    def _send(self, code, data, content_type, headers=dict()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, obj, code=200):
+        self._send(code, json.dumps(obj, indent=2).encode('utf-8'), 'application/json')
+
+    def _send_error(self, code, message):
+        self._send_json(dict(error=message), code)
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # accept bursts of concurrent clients
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128 # accept bursts of concurrent clients
+
+#----------------------------------------------------------------------------
+# Serve a previously trained generator over HTTP.
+# To run, uncomment the appropriate line in config.py and launch train.py.
+
+def serve(run_id, snapshot=None, host='localhost', port=8000, unix_socket=None, max_batch_size=64, max_latency=0.01, max_request_images=1024, out_shrink=1, png_compress_level=1, verbose=False):
+    network_pkl = misc.locate_network_pkl(run_id, snapshot)
+    print('Loading network from "%s"...' % network_pkl)
+    G, D, Gs = misc.load_network_pkl(run_id, snapshot, names=['Gs'])
+    print('Building inference graph...')
+    generator = BatchedGenerator(Gs, max_batch_size=max_batch_size, max_latency=max_latency, num_gpus=config.num_gpus, out_shrink=out_shrink)
+
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, InferenceRequestHandler)
+        print('Serving on unix socket %s...' % unix_socket)
+    else:
+        server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+        print('Serving on http://%s:%d/...' % (host, server.server_address[1]))
+    server.generator            = generator
+    server.max_request_images   = max_request_images
+    server.png_compress_level   = png_compress_level
+    server.verbose              = verbose
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    generator.close()
+    if unix_socket is not None and os.path.exists(unix_socket):
+        os.remove(unix_socket)
+
+#----------------------------------------------------------------------------
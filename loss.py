@@ -19,16 +19,23 @@ def fp32(*values):
     values = tuple(tf.cast(v, tf.float32) for v in values)
     return values if len(values) >= 2 else values[0]
 
+#----------------------------------------------------------------------------
+# Convenience func that selects the resolution at which G and D operate.
+# None = full resolution, <int> = resolution / 2**native_lod.
+
+def native_kwargs(native_lod):
+    return dict() if native_lod is None else dict(native_lod=native_lod)
+
 #----------------------------------------------------------------------------
 # Generator loss function used in the paper (WGAN + AC-GAN).
 
-def G_wgan_acgan(G, D, opt, training_set, minibatch_size,
+def G_wgan_acgan(G, D, opt, training_set, minibatch_size, native_lod=None,
     cond_weight = 1.0): # Weight of the conditioning term.
 
     latents = tf.random_normal([minibatch_size] + G.input_shapes[0][1:])
     labels = training_set.get_random_labels_tf(minibatch_size)
-    fake_images_out = G.get_output_for(latents, labels, is_training=True)
-    fake_scores_out, fake_labels_out = fp32(D.get_output_for(fake_images_out, is_training=True))
+    fake_images_out = G.get_output_for(latents, labels, is_training=True, **native_kwargs(native_lod))
+    fake_scores_out, fake_labels_out = fp32(D.get_output_for(fake_images_out, is_training=True, **native_kwargs(native_lod)))
     loss = -fake_scores_out
 
     if D.output_shapes[1][1] > 0:
@@ -40,16 +47,16 @@ def G_wgan_acgan(G, D, opt, training_set, minibatch_size,
 #----------------------------------------------------------------------------
 # Discriminator loss function used in the paper (WGAN-GP + AC-GAN).
 
-def D_wgangp_acgan(G, D, opt, training_set, minibatch_size, reals, labels,
+def D_wgangp_acgan(G, D, opt, training_set, minibatch_size, reals, labels, native_lod=None,
     wgan_lambda     = 10.0,     # Weight for the gradient penalty term.
     wgan_epsilon    = 0.001,    # Weight for the epsilon term, \epsilon_{drift}.
     wgan_target     = 1.0,      # Target value for gradient magnitudes.
     cond_weight     = 1.0):     # Weight of the conditioning terms.
 
     latents = tf.random_normal([minibatch_size] + G.input_shapes[0][1:])
-    fake_images_out = G.get_output_for(latents, labels, is_training=True)
-    real_scores_out, real_labels_out = fp32(D.get_output_for(reals, is_training=True))
-    fake_scores_out, fake_labels_out = fp32(D.get_output_for(fake_images_out, is_training=True))
+    fake_images_out = G.get_output_for(latents, labels, is_training=True, **native_kwargs(native_lod))
+    real_scores_out, real_labels_out = fp32(D.get_output_for(reals, is_training=True, **native_kwargs(native_lod)))
+    fake_scores_out, fake_labels_out = fp32(D.get_output_for(fake_images_out, is_training=True, **native_kwargs(native_lod)))
     real_scores_out = tfutil.autosummary('Loss/real_scores', real_scores_out)
     fake_scores_out = tfutil.autosummary('Loss/fake_scores', fake_scores_out)
     loss = fake_scores_out - real_scores_out
@@ -57,7 +64,7 @@ def D_wgangp_acgan(G, D, opt, training_set, minibatch_size, reals, labels,
     with tf.name_scope('GradientPenalty'):
         mixing_factors = tf.random_uniform([minibatch_size, 1, 1, 1], 0.0, 1.0, dtype=fake_images_out.dtype)
         mixed_images_out = tfutil.lerp(tf.cast(reals, fake_images_out.dtype), fake_images_out, mixing_factors)
-        mixed_scores_out, mixed_labels_out = fp32(D.get_output_for(mixed_images_out, is_training=True))
+        mixed_scores_out, mixed_labels_out = fp32(D.get_output_for(mixed_images_out, is_training=True, **native_kwargs(native_lod)))
         mixed_scores_out = tfutil.autosummary('Loss/mixed_scores', mixed_scores_out)
         mixed_loss = opt.apply_loss_scaling(tf.reduce_sum(mixed_scores_out))
         mixed_grads = opt.undo_loss_scaling(fp32(tf.gradients(mixed_loss, [mixed_images_out])[0]))
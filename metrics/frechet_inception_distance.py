@@ -38,6 +38,7 @@ from __future__ import absolute_import, division, print_function
 import numpy as np
 import scipy as sp
 import os
+import time
 import gzip, pickle
 import tensorflow as tf
 from scipy.misc import imread
@@ -245,6 +246,49 @@ if __name__ == "__main__":
 
 #----------------------------------------------------------------------------
 # EDIT: added
+# Frechet distance without sqrtm(). Since Tr(sqrt(C_1*C_2)) = Tr(sqrt(A*C_1*A))
+# for A = sqrt(C_2), and A*C_1*A is symmetric positive semi-definite, the trace
+# term is the sum of the square roots of its eigenvalues. A only depends on the
+# reals, so it is computed once per evaluation and each snapshot only needs a
+# symmetric eigenvalue decomposition.
+
+def calculate_sqrt_psd(sigma):
+    w, v = np.linalg.eigh(sigma)
+    return np.dot(v * np.sqrt(np.maximum(w, 0.0)), v.T)
+
+def calculate_frechet_distance_eigh(mu1, sigma1, mu2, sigma2, sqrt_sigma2=None):
+    if sqrt_sigma2 is None:
+        sqrt_sigma2 = calculate_sqrt_psd(sigma2)
+    m = np.square(mu1 - mu2).sum()
+    w = np.linalg.eigvalsh(np.dot(np.dot(sqrt_sigma2, sigma1), sqrt_sigma2))
+    s = np.sqrt(np.maximum(w, 0.0)).sum()
+    return m + np.trace(sigma1) + np.trace(sigma2) - 2 * s
+
+# Compare the accuracy and speed of calculate_frechet_distance_eigh() against sqrtm()
+# on synthetic statistics resembling the pool_3 activations.
+def benchmark_frechet_distance(dims=2048, num_samples=10000, num_repeats=3, random_seed=1000):
+    rnd = np.random.RandomState(random_seed)
+    stats = []
+    for shift in [0.0, 0.1]:
+        act = np.maximum(np.dot(rnd.randn(num_samples, dims), rnd.randn(dims, dims) / np.sqrt(dims)) + shift, 0.0)
+        stats.append((np.mean(act, axis=0), np.cov(act, rowvar=False)))
+    (mu_fake, sigma_fake), (mu_real, sigma_real) = stats
+    print('%-10s%-16s%-12s' % ('Method', 'FID', 'Time'))
+    print('%-10s%-16s%-12s' % ('---', '---', '---'))
+    ref = None
+    for method in ['sqrtm', 'eigh', 'eigh_pre']:
+        sqrt_sigma_real = calculate_sqrt_psd(sigma_real) if method == 'eigh_pre' else None
+        time_begin = time.time()
+        for repeat in range(num_repeats):
+            if method == 'sqrtm':
+                fid = calculate_frechet_distance(mu_fake, sigma_fake, mu_real, sigma_real)
+            else:
+                fid = calculate_frechet_distance_eigh(mu_fake, sigma_fake, mu_real, sigma_real, sqrt_sigma_real)
+        ref = fid if ref is None else ref
+        print('%-10s%-16.6f%-12.3f' % (method, fid, (time.time() - time_begin) / num_repeats), end='')
+        print('abs_err %.3e' % abs(fid - ref) if method != 'sqrtm' else '')
+
+#----------------------------------------------------------------------------
 
 class API:
     def __init__(self, num_images, image_shape, image_dtype, minibatch_size):
@@ -262,20 +306,41 @@ class API:
 
     def begin(self, mode):
         assert mode in ['warmup', 'reals', 'fakes']
-        self.activations = []
+        self.count = 0
+        self.act_sum = None
+        self.act_outer_sum = None
 
+    # Accumulate running sums in float64 instead of keeping all activations around.
     def feed(self, mode, minibatch):
-        act = get_activations(minibatch.transpose(0,2,3,1), self.sess, batch_size=minibatch.shape[0])
-        self.activations.append(act)
+        act = get_activations(minibatch.transpose(0,2,3,1), self.sess, batch_size=minibatch.shape[0]).astype(np.float64)
+        if self.act_sum is None:
+            self.act_sum = np.zeros(act.shape[1], dtype=np.float64)
+            self.act_outer_sum = np.zeros([act.shape[1], act.shape[1]], dtype=np.float64)
+        self.count += act.shape[0]
+        self.act_sum += act.sum(axis=0)
+        self.act_outer_sum += np.dot(act.T, act)
 
     def end(self, mode):
-        act = np.concatenate(self.activations)
-        mu = np.mean(act, axis=0)
-        sigma = np.cov(act, rowvar=False)
+        mu = self.act_sum / self.count
+        sigma = (self.act_outer_sum - self.count * np.outer(mu, mu)) / (self.count - 1) # same as np.cov(), i.e. ddof=1
+        self.act_sum = self.act_outer_sum = None
         if mode in ['warmup', 'reals']:
             self.mu_real = mu
             self.sigma_real = sigma
-        fid = calculate_frechet_distance(mu, sigma, self.mu_real, self.sigma_real)
+            self.sqrt_sigma_real = calculate_sqrt_psd(sigma)
+        fid = calculate_frechet_distance_eigh(mu, sigma, self.mu_real, self.sigma_real, self.sqrt_sigma_real)
         return [fid]
 
+    # Statistics of the reals that subsequent fakes are compared against, for caching.
+    def get_reals_version(self):
+        return 3 # 2 = statistics accumulated in float64, 3 = distance via eigendecomposition
+
+    def get_reals_state(self):
+        return dict(mu_real=self.mu_real, sigma_real=self.sigma_real)
+
+    def set_reals_state(self, state):
+        self.mu_real = state['mu_real']
+        self.sigma_real = state['sigma_real']
+        self.sqrt_sigma_real = calculate_sqrt_psd(self.sigma_real)
+
 #----------------------------------------------------------------------------
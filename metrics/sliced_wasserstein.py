@@ -7,18 +7,20 @@
 
 import numpy as np
 import scipy.ndimage
+import concurrent.futures
 
 #----------------------------------------------------------------------------
 
-def get_descriptors_for_minibatch(minibatch, nhood_size, nhoods_per_image):
+def get_descriptors_for_minibatch(minibatch, nhood_size, nhoods_per_image, random_state=None):
+    rnd = np.random if random_state is None else random_state
     S = minibatch.shape # (minibatch, channel, height, width)
     assert len(S) == 4 and S[1] == 3
     N = nhoods_per_image * S[0]
     H = nhood_size // 2
     nhood, chan, x, y = np.ogrid[0:N, 0:3, -H:H+1, -H:H+1]
     img = nhood // nhoods_per_image
-    x = x + np.random.randint(H, S[3] - H, size=(N, 1, 1, 1))
-    y = y + np.random.randint(H, S[2] - H, size=(N, 1, 1, 1))
+    x = x + rnd.randint(H, S[3] - H, size=(N, 1, 1, 1))
+    y = y + rnd.randint(H, S[2] - H, size=(N, 1, 1, 1))
     idx = ((img * S[1] + chan) * S[2] + y) * S[3] + x
     return minibatch.flat[idx]
 
@@ -34,20 +36,81 @@ def finalize_descriptors(desc):
     return desc
 
 #----------------------------------------------------------------------------
+# Memory-bounded alternative to collecting all descriptors in a list.
+# Keeps a uniform random sample of at most max_descriptors descriptors
+# (reservoir sampling) together with running float64 per-channel sums, so
+# that the sample is normalized with the statistics of all descriptors.
+
+class DescriptorReservoir:
+    def __init__(self, max_descriptors, random_state=None):
+        self.max_descriptors    = max_descriptors
+        self.random_state       = np.random if random_state is None else random_state
+        self.num_seen           = 0
+        self.samples            = None      # (neighborhood, channel, height, width)
+        self.sum                = None      # (channel,)
+        self.sum_sq             = None      # (channel,)
+        self.num_values         = 0         # Number of values per channel seen so far.
+
+    def add(self, desc):
+        desc = desc.astype(np.float32)
+        if self.samples is None:
+            self.samples = np.empty((self.max_descriptors,) + desc.shape[1:], dtype=np.float32)
+            self.sum = np.zeros(desc.shape[1], dtype=np.float64)
+            self.sum_sq = np.zeros(desc.shape[1], dtype=np.float64)
+        vals = desc.astype(np.float64)
+        self.sum += np.sum(vals, axis=(0, 2, 3))
+        self.sum_sq += np.sum(np.square(vals), axis=(0, 2, 3))
+        self.num_values += desc.shape[0] * desc.shape[2] * desc.shape[3]
+
+        # Fill the reservoir first, then replace random samples with decreasing probability.
+        num_fill = max(min(self.max_descriptors - self.num_seen, desc.shape[0]), 0)
+        self.samples[self.num_seen : self.num_seen + num_fill] = desc[:num_fill]
+        pos = self.random_state.randint(0, np.arange(self.num_seen + num_fill, self.num_seen + desc.shape[0]) + 1)
+        keep = pos < self.max_descriptors
+        self.samples[pos[keep]] = desc[num_fill:][keep]
+        self.num_seen += desc.shape[0]
+
+    def finalize(self): # => (neighborhood, descriptor_component), same as finalize_descriptors()
+        desc = self.samples[:min(self.num_seen, self.max_descriptors)]
+        mean = self.sum / self.num_values
+        std = np.sqrt(np.maximum(self.sum_sq / self.num_values - np.square(mean), 0.0))
+        desc -= mean.astype(np.float32)[np.newaxis, :, np.newaxis, np.newaxis]
+        desc /= std.astype(np.float32)[np.newaxis, :, np.newaxis, np.newaxis]
+        return desc.reshape(desc.shape[0], -1)
 
-def sliced_wasserstein(A, B, dir_repeats, dirs_per_repeat):
+#----------------------------------------------------------------------------
+
+def sliced_wasserstein(A, B, dir_repeats, dirs_per_repeat, num_threads=1, random_state=None):
     assert A.ndim == 2 and A.shape == B.shape                           # (neighborhood, descriptor_component)
-    results = []
+    rnd = np.random if random_state is None else random_state
+    all_dirs = []
     for repeat in range(dir_repeats):
-        dirs = np.random.randn(A.shape[1], dirs_per_repeat)             # (descriptor_component, direction)
+        dirs = rnd.randn(A.shape[1], dirs_per_repeat)             # (descriptor_component, direction)
         dirs /= np.sqrt(np.sum(np.square(dirs), axis=0, keepdims=True)) # normalize descriptor components for each direction
-        dirs = dirs.astype(np.float32)
-        projA = np.matmul(A, dirs)                                      # (neighborhood, direction)
-        projB = np.matmul(B, dirs)
-        projA = np.sort(projA, axis=0)                                  # sort neighborhood projections for each direction
-        projB = np.sort(projB, axis=0)
-        dists = np.abs(projA - projB)                                   # pointwise wasserstein distances
-        results.append(np.mean(dists))                                  # average over neighborhoods and directions
+        all_dirs.append(dirs.astype(np.float32))
+
+    # Each thread reuses its own projection buffers for its share of the repeats.
+    def process_repeats(repeats):
+        projA = np.empty((A.shape[0], dirs_per_repeat), dtype=np.float32) # (neighborhood, direction)
+        projB = np.empty((B.shape[0], dirs_per_repeat), dtype=np.float32)
+        results = []
+        for repeat in repeats:
+            np.matmul(A, all_dirs[repeat], out=projA)
+            np.matmul(B, all_dirs[repeat], out=projB)
+            projA.sort(axis=0)                                          # sort neighborhood projections for each direction
+            projB.sort(axis=0)
+            np.subtract(projA, projB, out=projA)
+            np.abs(projA, out=projA)                                    # pointwise wasserstein distances
+            results.append(np.mean(projA))                              # average over neighborhoods and directions
+        return results
+
+    num_threads = max(min(num_threads, dir_repeats), 1)
+    chunks = np.array_split(np.arange(dir_repeats), num_threads)
+    if num_threads == 1:
+        results = process_repeats(chunks[0])
+    else:
+        with concurrent.futures.ThreadPoolExecutor(num_threads) as pool:
+            results = sum(pool.map(process_repeats, chunks), [])
     return np.mean(results)                                             # average over repeats
 
 #----------------------------------------------------------------------------
@@ -96,11 +159,13 @@ def reconstruct_laplacian_pyramid(pyramid):
 #----------------------------------------------------------------------------
 
 class API:
-    def __init__(self, num_images, image_shape, image_dtype, minibatch_size):
+    def __init__(self, num_images, image_shape, image_dtype, minibatch_size, max_descriptors=None, num_threads=1):
         self.nhood_size         = 7
         self.nhoods_per_image   = 128
         self.dir_repeats        = 4
         self.dirs_per_repeat    = 128
+        self.max_descriptors    = max_descriptors   # Max descriptors to keep per level, None = keep all.
+        self.num_threads        = num_threads       # Number of threads for the dir_repeats loop.
         self.resolutions = []
         res = image_shape[1]
         while res >= 16:
@@ -115,21 +180,41 @@ class API:
 
     def begin(self, mode):
         assert mode in ['warmup', 'reals', 'fakes']
-        self.descriptors = [[] for res in self.resolutions]
+        self.random_state = np.random.RandomState(np.random.randint(1 << 31)) # seeded by the caller, so that the results do not depend on which thread feeds the metric
+        if self.max_descriptors is None:
+            self.descriptors = [[] for res in self.resolutions]
+        else:
+            self.descriptors = [DescriptorReservoir(self.max_descriptors, self.random_state) for res in self.resolutions]
 
     def feed(self, mode, minibatch):
         for lod, level in enumerate(generate_laplacian_pyramid(minibatch, len(self.resolutions))):
-            desc = get_descriptors_for_minibatch(level, self.nhood_size, self.nhoods_per_image)
-            self.descriptors[lod].append(desc)
+            desc = get_descriptors_for_minibatch(level, self.nhood_size, self.nhoods_per_image, self.random_state)
+            if self.max_descriptors is None:
+                self.descriptors[lod].append(desc)
+            else:
+                self.descriptors[lod].add(desc)
 
     def end(self, mode):
-        desc = [finalize_descriptors(d) for d in self.descriptors]
+        if self.max_descriptors is None:
+            desc = [finalize_descriptors(d) for d in self.descriptors]
+        else:
+            desc = [d.finalize() for d in self.descriptors]
         del self.descriptors
         if mode in ['warmup', 'reals']:
             self.desc_real = desc
-        dist = [sliced_wasserstein(dreal, dfake, self.dir_repeats, self.dirs_per_repeat) for dreal, dfake in zip(self.desc_real, desc)]
+        dist = [sliced_wasserstein(dreal, dfake, self.dir_repeats, self.dirs_per_repeat, self.num_threads, self.random_state) for dreal, dfake in zip(self.desc_real, desc)]
         del desc
         dist = [d * 1e3 for d in dist] # multiply by 10^3
         return dist + [np.mean(dist)]
 
+    # Statistics of the reals that subsequent fakes are compared against, for caching.
+    def get_reals_version(self):
+        return 1
+
+    def get_reals_state(self):
+        return self.desc_real
+
+    def set_reals_state(self, state):
+        self.desc_real = state
+
 #----------------------------------------------------------------------------
@@ -10,6 +10,11 @@ import sys
 import glob
 import datetime
 import pickle
+import copyreg
+import threading
+import json
+import struct
+import zlib
 import re
 import numpy as np
 from collections import OrderedDict 
@@ -19,19 +24,284 @@ import PIL.Image
 import config
 import dataset
 import legacy
+import tfutil
 
 #----------------------------------------------------------------------------
 # Convenience wrappers for pickle that are able to load data produced by
 # older versions of the code.
 
-def load_pkl(filename):
+def load_pkl(filename, names=None): # names = list of network names to load (e.g. ['Gs']), others are returned as None. None = load everything.
+    if filename.endswith(delta_suffix):
+        return tuple(None if state is None else NetworkState(state).construct() for state in load_network_states(filename, names))
     with open(filename, 'rb') as file:
-        return legacy.LegacyUnpickler(file, encoding='latin1').load()
+        if file.read(len(snapshot_magic)) == snapshot_magic:
+            return tuple(None if state is None else NetworkState(state).construct() for state in load_snapshot_states(filename, names))
+        file.seek(0)
+        if names is None:
+            return legacy.LegacyUnpickler(file, encoding='latin1').load()
+        obj = NetworkStateUnpickler(file, encoding='latin1').load()
+        return _select_networks(obj, _resolve_names([net.state for net in _list_networks(obj)], names))
 
 def save_pkl(obj, filename):
     with open(filename, 'wb') as file:
         pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
 
+#----------------------------------------------------------------------------
+# Unpickler that returns the pickled state of each network instead of
+# constructing it, so that networks can be selected or inspected without
+# building their graphs.
+
+class NetworkState:
+    def __init__(self, state=None):
+        self.state = state
+
+    def __setstate__(self, state):
+        for handler in tfutil.network_import_handlers: # convert legacy data, so that the name and variables are valid
+            state = handler(state)
+        self.state = state
+
+    def construct(self): # => tfutil.Network
+        net = object.__new__(tfutil.Network)
+        net.__setstate__(self.state)
+        return net
+
+class NetworkStateUnpickler(legacy.LegacyUnpickler):
+    def find_class(self, module, name):
+        if super().find_class(module, name) is tfutil.Network:
+            return NetworkState
+        return super().find_class(module, name)
+
+def _list_networks(obj): # => [NetworkState, ...]
+    if isinstance(obj, (tuple, list)):
+        return [net for x in obj for net in _list_networks(x)]
+    return [obj] if isinstance(obj, NetworkState) else []
+
+def _select_networks(obj, names):
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_select_networks(x, names) for x in obj)
+    if isinstance(obj, NetworkState):
+        return obj.construct() if names is None or obj.state['name'] in names else None
+    return obj
+
+# Networks converted from the old Theano implementation are named after their build func (e.g. 'G_paper' for both G and Gs),
+# so they cannot be selected by name. Select all networks if none of the names match.
+def _resolve_names(states, names): # => names or None
+    if names is not None and not any(state['name'] in names for state in states):
+        return None
+    return names
+
+# Load the states of a tuple of networks from a snapshot in any format, without constructing them.
+def load_network_states(filename, names=None): # => (state, ...), None for networks not listed in names
+    if filename.endswith(delta_suffix):
+        return load_delta_states(filename, names)
+    with open(filename, 'rb') as file:
+        if file.read(len(snapshot_magic)) == snapshot_magic:
+            return load_snapshot_states(filename, names)
+        file.seek(0)
+        nets = NetworkStateUnpickler(file, encoding='latin1').load()
+    names = _resolve_names([net.state for net in nets], names)
+    return tuple(net.state if names is None or net.state['name'] in names else None for net in nets)
+
+#----------------------------------------------------------------------------
+# Chunked network snapshot format: magic, uint64 header length, JSON header
+# describing each network and its variables, and the raw variable values,
+# each aligned to 64 bytes. Unlike a pickle, the file can be memory-mapped and
+# individual networks can be loaded without reading the others. Variables can
+# optionally be stored as float16 to halve the size. load_pkl() detects the
+# format automatically.
+
+snapshot_magic = b'PGANSNAP'
+snapshot_align = 64
+
+def save_snapshot(states, file, fp16=False): # states = [Network.get_state(), ...]
+    nets = []
+    blobs = []
+    offset = 0
+    for state in states:
+        assert state['version'] == 2
+        net = {key: value for key, value in state.items() if key != 'variables'}
+        net['variables'] = []
+        for name, value in state['variables']:
+            value = np.asarray(value)
+            if fp16 and value.dtype == np.float32:
+                value = value.astype(np.float16)
+            net['variables'].append(dict(name=name, shape=list(value.shape), dtype=value.dtype.name, offset=offset))
+            blobs.append(value)
+            offset += (value.nbytes + snapshot_align - 1) // snapshot_align * snapshot_align
+        nets.append(net)
+    header = json.dumps(dict(version=1, networks=nets), default=lambda x: x.item()).encode('utf-8')
+    data_start = (len(snapshot_magic) + 8 + len(header) + snapshot_align - 1) // snapshot_align * snapshot_align
+    file.write(snapshot_magic + struct.pack('<Q', len(header)) + header)
+    file.write(b'\0' * (data_start - len(snapshot_magic) - 8 - len(header)))
+    for value in blobs:
+        file.write(np.ascontiguousarray(value).tobytes())
+        file.write(b'\0' * (-value.nbytes % snapshot_align))
+
+def load_snapshot_states(filename, names=None): # => (state, ...), None for networks not listed in names
+    with open(filename, 'rb') as file:
+        assert file.read(len(snapshot_magic)) == snapshot_magic
+        header_len = struct.unpack('<Q', file.read(8))[0]
+        header = json.loads(file.read(header_len).decode('utf-8'))
+    assert header['version'] == 1
+    data_start = (len(snapshot_magic) + 8 + header_len + snapshot_align - 1) // snapshot_align * snapshot_align
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    states = []
+    for net in header['networks']:
+        if names is not None and net['name'] not in names:
+            states.append(None)
+            continue
+        state = {key: value for key, value in net.items() if key != 'variables'}
+        state['variables'] = []
+        for var in net['variables']:
+            value = np.frombuffer(data, dtype=var['dtype'], count=int(np.prod(var['shape'])), offset=data_start + var['offset']).reshape(var['shape'])
+            if value.dtype == np.float16:
+                value = value.astype(np.float32)
+            state['variables'].append((var['name'], value))
+        states.append(state)
+    return tuple(states)
+
+#----------------------------------------------------------------------------
+# Delta snapshots store, for each variable, only the zlib-compressed XOR of
+# its bytes against the same variable in a previous full snapshot (keyframe).
+# Unchanged variables are stored as plain references. Consecutive snapshots share most
+# of the sign and exponent bits of their weights, so the XOR compresses well.
+# Deltas are pickled dicts named network-snapshot-NNNNNN.delta and are read
+# transparently by load_pkl() and load_network_states().
+
+delta_suffix = '.delta'
+
+def save_delta(states, keyframe_states, keyframe_name, file):
+    nets = []
+    for state, keyframe_state in zip(states, keyframe_states):
+        keyframe_vars = dict(keyframe_state['variables'])
+        net = {key: value for key, value in state.items() if key != 'variables'}
+        net['variables'] = []
+        for name, value in state['variables']:
+            value = np.ascontiguousarray(value)
+            base = keyframe_vars.get(name)
+            if base is not None and base.dtype == value.dtype and base.shape == value.shape:
+                bits = value.view(np.uint8) ^ np.ascontiguousarray(base).view(np.uint8)
+                payload = ('xor', zlib.compress(bits.tobytes())) if bits.any() else ('same', None)
+            else:
+                payload = ('raw', zlib.compress(value.tobytes()))
+            net['variables'].append((name, value.dtype.name, list(value.shape)) + payload)
+        nets.append(net)
+    pickle.dump(dict(version=1, keyframe=keyframe_name, networks=nets), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_delta_states(filename, names=None): # => (state, ...), None for networks not listed in names
+    with open(filename, 'rb') as file:
+        delta = pickle.load(file)
+    assert delta['version'] == 1
+    keyframe_states = load_network_states(os.path.join(os.path.dirname(filename), delta['keyframe']), names)
+    states = []
+    for net, keyframe_state in zip(delta['networks'], keyframe_states):
+        if keyframe_state is None:
+            states.append(None)
+            continue
+        keyframe_vars = dict(keyframe_state['variables'])
+        state = {key: value for key, value in net.items() if key != 'variables'}
+        state['variables'] = []
+        for name, dtype, shape, kind, payload in net['variables']:
+            if kind == 'same':
+                value = keyframe_vars[name]
+            else:
+                bits = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+                if kind == 'xor':
+                    bits = bits ^ np.ascontiguousarray(keyframe_vars[name], dtype=dtype).view(np.uint8).ravel()
+                value = bits.view(dtype).reshape(shape)
+            state['variables'].append((name, value))
+        states.append(state)
+    return tuple(states)
+
+# Save a tuple of networks in the given format, 'pkl' or 'chunked'.
+def save_networks(nets, filename, format='pkl', fp16=False):
+    if format == 'pkl':
+        save_pkl(nets, filename)
+    else:
+        assert format == 'chunked'
+        with open(filename, 'wb') as file:
+            save_snapshot([net.get_state() for net in nets], file, fp16)
+
+#----------------------------------------------------------------------------
+# Network snapshot writer that does not block the caller. save() fetches the
+# variables of all networks in a single run() and returns immediately, while a
+# background thread pickles them, fsyncs, and finally renames the temporary
+# file to its real name. The rename is atomic, so list_network_pkls() never
+# sees a partially written snapshot. The resulting file is byte-identical to
+# save_networks() of the same networks. At most one snapshot is written at a time.
+#
+# With keyframe_interval > 0, only every keyframe_interval'th snapshot is
+# written in full; the ones in between are written as deltas against the
+# most recent full snapshot, using the .delta suffix instead of .pkl.
+
+class _NetworkStateForPickle: # Pickles exactly like a tfutil.Network with the given state.
+    def __init__(self, state):
+        self.state = state
+
+    @property
+    def __class__(self):
+        return tfutil.Network
+
+    def __reduce_ex__(self, protocol):
+        return (copyreg.__newobj__, (tfutil.Network,), self.state)
+
+class AsyncSnapshotWriter:
+    def __init__(self, format='pkl', fp16=False, keyframe_interval=0):
+        assert format in ['pkl', 'chunked']
+        self.format             = format
+        self.fp16               = fp16
+        self.keyframe_interval  = keyframe_interval
+        self._num_saved         = 0
+        self._keyframe          = None      # (filename, states) of the most recent full snapshot.
+        self._thread            = None
+        self._exception         = None
+
+    def save(self, nets, filename, allow_delta=True): # nets = tuple of tfutil.Network
+        values = tfutil.run([list(net.vars.values()) for net in nets])
+        states = [net.get_state(vals) for net, vals in zip(nets, values)]
+        keyframe = None
+        if self.keyframe_interval > 0:
+            if allow_delta and self._keyframe is not None and self._num_saved % self.keyframe_interval != 0:
+                keyframe = self._keyframe
+                states = [self._as_stored(state) for state in states]
+                filename = os.path.splitext(filename)[0] + delta_suffix
+            else:
+                self._keyframe = (filename, [self._as_stored(state) for state in states])
+            self._num_saved += 1
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(states, keyframe, filename))
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._exception is not None:
+            e, self._exception = self._exception, None
+            raise e
+
+    def _as_stored(self, state): # Variable values as they will read back from the snapshot file.
+        if self.format == 'chunked' and self.fp16:
+            state = dict(state)
+            state['variables'] = [(name, value.astype(np.float16).astype(np.float32) if value.dtype == np.float32 else value) for name, value in state['variables']]
+        return state
+
+    def _write(self, states, keyframe, filename):
+        try:
+            tmp_filename = filename + '.tmp'
+            with open(tmp_filename, 'wb') as file:
+                if keyframe is not None:
+                    save_delta(states, keyframe[1], os.path.basename(keyframe[0]), file)
+                elif self.format == 'pkl':
+                    pickle.dump(tuple(_NetworkStateForPickle(state) for state in states), file, protocol=pickle.HIGHEST_PROTOCOL)
+                else:
+                    save_snapshot(states, file, self.fp16)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_filename, filename)
+        except Exception as e:
+            self._exception = e
+
 #----------------------------------------------------------------------------
 # Image utils.
 
@@ -207,7 +477,7 @@ def locate_result_subdir(run_id_or_result_subdir):
 
 def list_network_pkls(run_id_or_result_subdir, include_final=True):
     result_subdir = locate_result_subdir(run_id_or_result_subdir)
-    pkls = sorted(glob.glob(os.path.join(result_subdir, 'network-*.pkl')))
+    pkls = sorted(glob.glob(os.path.join(result_subdir, 'network-*.pkl')) + glob.glob(os.path.join(result_subdir, 'network-*' + delta_suffix)))
     if len(pkls) >= 1 and os.path.basename(pkls[0]) == 'network-final.pkl':
         if include_final:
             pkls.append(pkls[0])
@@ -232,14 +502,14 @@ def locate_network_pkl(run_id_or_result_subdir_or_network_pkl, snapshot=None):
     raise IOError('Cannot locate network pkl for snapshot', snapshot)
 
 def get_id_string_for_network_pkl(network_pkl):
-    p = network_pkl.replace('.pkl', '').replace('\\', '/').split('/')
+    p = network_pkl.replace('.pkl', '').replace(delta_suffix, '').replace('\\', '/').split('/')
     return '-'.join(p[max(len(p) - 2, 0):])
 
 #----------------------------------------------------------------------------
 # Loading and using trained networks.
 
-def load_network_pkl(run_id_or_result_subdir_or_network_pkl, snapshot=None):
-    return load_pkl(locate_network_pkl(run_id_or_result_subdir_or_network_pkl, snapshot))
+def load_network_pkl(run_id_or_result_subdir_or_network_pkl, snapshot=None, names=None):
+    return load_pkl(locate_network_pkl(run_id_or_result_subdir_or_network_pkl, snapshot), names)
 
 def random_latents(num_latents, G, random_state=None):
     if random_state is not None:
@@ -159,11 +159,13 @@ def G_paper(
     dtype               = 'float32',    # Data type to use for activations and outputs.
     fused_scale         = True,         # True = use fused upscale2d + conv2d, False = separate upscale2d layers.
     structure           = None,         # 'linear' = human-readable, 'recursive' = efficient, None = select automatically.
+    native_lod          = 0,            # Output images at resolution / 2**native_lod, omitting the higher-resolution layers. Requires lod >= native_lod.
     is_template_graph   = False,        # True = template graph constructed by the Network class, False = actual evaluation.
     **kwargs):                          # Ignore unrecognized keyword args.
     
     resolution_log2 = int(np.log2(resolution))
     assert resolution == 2**resolution_log2 and resolution >= 4
+    assert 0 <= native_lod <= resolution_log2 - 2
     def nf(stage): return min(int(fmap_base / (2.0 ** (stage * fmap_decay))), fmap_max)
     def PN(x): return pixel_norm(x, epsilon=pixelnorm_epsilon) if use_pixelnorm else x
     if latent_size is None: latent_size = nf(0)
@@ -206,7 +208,7 @@ def G_paper(
     if structure == 'linear':
         x = block(combo_in, 2)
         images_out = torgb(x, 2)
-        for res in range(3, resolution_log2 + 1):
+        for res in range(3, resolution_log2 - native_lod + 1):
             lod = resolution_log2 - res
             x = block(x, res)
             img = torgb(x, res)
@@ -218,9 +220,9 @@ def G_paper(
     if structure == 'recursive':
         def grow(x, res, lod):
             y = block(x, res)
-            img = lambda: upscale2d(torgb(y, res), 2**lod)
-            if res > 2: img = cset(img, (lod_in > lod), lambda: upscale2d(lerp(torgb(y, res), upscale2d(torgb(x, res - 1)), lod_in - lod), 2**lod))
-            if lod > 0: img = cset(img, (lod_in < lod), lambda: grow(y, res + 1, lod - 1))
+            img = lambda: upscale2d(torgb(y, res), 2**(lod - native_lod))
+            if res > 2: img = cset(img, (lod_in > lod), lambda: upscale2d(lerp(torgb(y, res), upscale2d(torgb(x, res - 1)), lod_in - lod), 2**(lod - native_lod)))
+            if lod > native_lod: img = cset(img, (lod_in < lod), lambda: grow(y, res + 1, lod - 1))
             return img()
         images_out = grow(combo_in, 2, resolution_log2 - 2)
         
@@ -244,16 +246,18 @@ def D_paper(
     dtype               = 'float32',    # Data type to use for activations and outputs.
     fused_scale         = True,         # True = use fused conv2d + downscale2d, False = separate downscale2d layers.
     structure           = None,         # 'linear' = human-readable, 'recursive' = efficient, None = select automatically
+    native_lod          = 0,            # Accept images at resolution / 2**native_lod, omitting the higher-resolution layers. Requires lod >= native_lod.
     is_template_graph   = False,        # True = template graph constructed by the Network class, False = actual evaluation.
     **kwargs):                          # Ignore unrecognized keyword args.
     
     resolution_log2 = int(np.log2(resolution))
     assert resolution == 2**resolution_log2 and resolution >= 4
+    assert 0 <= native_lod <= resolution_log2 - 2
     def nf(stage): return min(int(fmap_base / (2.0 ** (stage * fmap_decay))), fmap_max)
     if structure is None: structure = 'linear' if is_template_graph else 'recursive'
     act = leaky_relu
 
-    images_in.set_shape([None, num_channels, resolution, resolution])
+    images_in.set_shape([None, num_channels, resolution >> native_lod, resolution >> native_lod])
     images_in = tf.cast(images_in, dtype)
     lod_in = tf.cast(tf.get_variable('lod', initializer=np.float32(0.0), trainable=False), dtype)
 
@@ -287,8 +291,8 @@ def D_paper(
     # Linear structure: simple but inefficient.
     if structure == 'linear':
         img = images_in
-        x = fromrgb(img, resolution_log2)
-        for res in range(resolution_log2, 2, -1):
+        x = fromrgb(img, resolution_log2 - native_lod)
+        for res in range(resolution_log2 - native_lod, 2, -1):
             lod = resolution_log2 - res
             x = block(x, res)
             img = downscale2d(img)
@@ -300,10 +304,10 @@ def D_paper(
     # Recursive structure: complex but efficient.
     if structure == 'recursive':
         def grow(res, lod):
-            x = lambda: fromrgb(downscale2d(images_in, 2**lod), res)
-            if lod > 0: x = cset(x, (lod_in < lod), lambda: grow(res + 1, lod - 1))
+            x = lambda: fromrgb(downscale2d(images_in, 2**(lod - native_lod)), res)
+            if lod > native_lod: x = cset(x, (lod_in < lod), lambda: grow(res + 1, lod - 1))
             x = block(x(), res); y = lambda: x
-            if res > 2: y = cset(y, (lod_in > lod), lambda: lerp(x, fromrgb(downscale2d(images_in, 2**(lod+1)), res - 1), lod_in - lod))
+            if res > 2: y = cset(y, (lod_in > lod), lambda: lerp(x, fromrgb(downscale2d(images_in, 2**(lod+1-native_lod)), res - 1), lod_in - lod))
             return y()
         combo_out = grow(2, resolution_log2 - 2)
 
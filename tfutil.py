@@ -49,6 +49,11 @@ def lerp_clip(a, b, t):
 def absolute_name_scope(scope): # Forcefully enter the specified name scope, ignoring any surrounding scopes.
     return tf.name_scope(scope + '/')
 
+def ordered_var_reads(): # Make existing variables read within the scope (e.g. by Network.get_output_for()) obey the surrounding control_dependencies.
+    def custom_getter(getter, *args, **kwargs):
+        return getter(*args, **kwargs).read_value() # new read op, unlike tf.identity() which may reuse the cached snapshot of a RefVariable
+    return tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter, auxiliary_name_scope=False)
+
 #----------------------------------------------------------------------------
 # Initialize TensorFlow graph and session using good default settings.
 
@@ -268,15 +273,12 @@ class Optimizer:
         self.loss_scaling_dec   = loss_scaling_dec
         self._grad_shapes       = None          # [shape, ...]
         self._dev_opt           = OrderedDict() # device => optimizer
-        self._dev_grads         = OrderedDict() # device => [[(grad, var), ...], ...]
+        self._dev_grads         = OrderedDict() # device => [[(grad, var), ...], ...], registered since the last apply_updates()
         self._dev_ls_var        = OrderedDict() # device => variable (log2 of loss scaling factor)
-        self._updates_applied   = False
 
     # Register the gradients of the given loss function with respect to the given variables.
     # Intended to be called once per GPU.
     def register_gradients(self, loss, vars):
-        assert not self._updates_applied
-
         # Validate arguments.
         if isinstance(vars, dict):
             vars = list(vars.values()) # allow passing in Network.trainables as vars
@@ -297,16 +299,21 @@ class Optimizer:
                 self._dev_grads[dev] = []
             loss = self.apply_loss_scaling(tf.cast(loss, tf.float32))
             grads = self._dev_opt[dev].compute_gradients(loss, vars, gate_gradients=tf.train.Optimizer.GATE_NONE) # disable gating to reduce memory usage
-            grads = [(g, v) if g is not None else (tf.zeros_like(v), v) for g, v in grads] # replace disconnected gradients with zeros
             self._dev_grads[dev].append(grads)
 
     # Construct training op to update the registered variables based on their gradients.
-    def apply_updates(self):
-        assert not self._updates_applied
-        self._updates_applied = True
-        devices = list(self._dev_grads.keys())
+    # Can be called several times, e.g. once per alternative loss, each time consuming the gradients
+    # registered since the previous call. The resulting ops share the optimizer state and loss scaling.
+    # Disconnected gradients are replaced with zeros, or with drop_disconnected, the variables that
+    # are disconnected from all of the losses are left out of the update altogether.
+    def apply_updates(self, drop_disconnected=False):
+        devices = [dev for dev, grads in self._dev_grads.items() if len(grads)]
         total_grads = sum(len(grads) for grads in self._dev_grads.values())
         assert len(devices) >= 1 and total_grads >= 1
+        var_idxs = list(range(len(self._grad_shapes)))
+        if drop_disconnected:
+            var_idxs = [idx for idx in var_idxs if any(grads[idx][0] is not None for dev in devices for grads in self._dev_grads[dev])]
+            assert len(var_idxs) >= 1
         ops = []
         with absolute_name_scope(self.scope):
 
@@ -315,9 +322,10 @@ class Optimizer:
             for dev_idx, dev in enumerate(devices):
                 with tf.name_scope('ProcessGrads%d' % dev_idx), tf.device(dev):
                     sums = []
-                    for gv in zip(*self._dev_grads[dev]):
+                    for var_idx in var_idxs:
+                        gv = [grads[var_idx] for grads in self._dev_grads[dev]]
                         assert all(v is gv[0][1] for g, v in gv)
-                        g = [tf.cast(g, tf.float32) for g, v in gv]
+                        g = [tf.cast(g if g is not None else tf.zeros_like(v), tf.float32) for g, v in gv] # replace disconnected gradients with zeros
                         g = g[0] if len(g) == 1 else tf.add_n(g)
                         sums.append((g, gv[0][1]))
                     dev_grads[dev] = sums
@@ -325,12 +333,12 @@ class Optimizer:
             # Sum gradients across devices.
             if len(devices) > 1:
                 with tf.name_scope('SumAcrossGPUs'), tf.device(None):
-                    for var_idx, grad_shape in enumerate(self._grad_shapes):
-                        g = [dev_grads[dev][var_idx][0] for dev in devices]
-                        if np.prod(grad_shape): # nccl does not support zero-sized tensors
+                    for idx, var_idx in enumerate(var_idxs):
+                        g = [dev_grads[dev][idx][0] for dev in devices]
+                        if np.prod(self._grad_shapes[var_idx]): # nccl does not support zero-sized tensors
                             g = tf.contrib.nccl.all_sum(g)
                         for dev, gg in zip(devices, g):
-                            dev_grads[dev][var_idx] = (gg, dev_grads[dev][var_idx][1])
+                            dev_grads[dev][idx] = (gg, dev_grads[dev][idx][1])
 
             # Apply updates separately on each device.
             for dev_idx, (dev, grads) in enumerate(dev_grads.items()):
@@ -369,6 +377,8 @@ class Optimizer:
             # Initialize variables and group everything into a single op.
             self.reset_optimizer_state()
             init_uninited_vars(list(self._dev_ls_var.values()))
+            for dev in self._dev_grads:
+                self._dev_grads[dev] = []
             return tf.group(*ops, name='TrainingOp')
 
     # Reset internal state of the underlying optimizer.
@@ -538,13 +548,21 @@ class Network:
 
     # Pickle export.
     def __getstate__(self):
+        return self.get_state()
+
+    # Get the pickled state of the network. If var_values is given, it is used instead of
+    # reading the variables, e.g. to fetch the variables of several networks in a single run().
+    def get_state(self, var_values=None):
+        if var_values is None:
+            var_values = run(list(self.vars.values()))
+        assert len(var_values) == len(self.vars)
         return {
             'version':          2,
             'name':             self.name,
             'static_kwargs':    self.static_kwargs,
             'build_module_src': self._build_module_src,
             'build_func_name':  self._build_func_name,
-            'variables':        list(zip(self.vars.keys(), run(list(self.vars.values()))))}
+            'variables':        list(zip(self.vars.keys(), var_values))}
 
     # Pickle import.
     def __setstate__(self, state):
@@ -572,6 +590,19 @@ class Network:
         self.reset_vars()
         set_vars({self.find_var(name): value for name, value in state['variables']})
 
+    # Load the variables from a pickled state without rebuilding the graph.
+    # Returns False, leaving the network untouched, if the state has a different architecture.
+    def set_state(self, state):
+        for handler in network_import_handlers:
+            state = handler(state)
+        assert state['version'] == 2
+        if state['build_module_src'] != self._build_module_src or state['build_func_name'] != self._build_func_name:
+            return False
+        if state['static_kwargs'] != self.static_kwargs or set(name for name, value in state['variables']) != set(self.vars.keys()):
+            return False
+        set_vars({self.find_var(name): value for name, value in state['variables']})
+        return True
+
     # Create a clone of this network with its own copy of the variables.
     def clone(self, name=None):
         net = object.__new__(Network)
@@ -6,7 +6,10 @@
 # Creative Commons, PO Box 1866, Mountain View, CA 94042, USA.
 
 import os
+import glob
 import time
+import threading
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 
@@ -52,32 +55,42 @@ def setup_snapshot_image_grid(G, training_set,
 
 #----------------------------------------------------------------------------
 # Just-in-time processing of training images before feeding them to the networks.
+# Split into the part that operates at the resolution of the dataset
+# (process_reals_lowres) and the final upscale (upscale_reals), so that the
+# former can optionally be run on the CPU.
 
 def process_reals(x, lod, mirror_augment, drange_data, drange_net):
     with tf.name_scope('ProcessReals'):
-        with tf.name_scope('DynamicRange'):
-            x = tf.cast(x, tf.float32)
-            x = misc.adjust_dynamic_range(x, drange_data, drange_net)
-        if mirror_augment:
-            with tf.name_scope('MirrorAugment'):
-                s = tf.shape(x)
-                mask = tf.random_uniform([s[0], 1, 1, 1], 0.0, 1.0)
-                mask = tf.tile(mask, [1, s[1], s[2], s[3]])
-                x = tf.where(mask < 0.5, x, tf.reverse(x, axis=[3]))
-        with tf.name_scope('FadeLOD'): # Smooth crossfade between consecutive levels-of-detail.
+        x = process_reals_lowres(x, lod, mirror_augment, drange_data, drange_net)
+        return upscale_reals(x, lod)
+
+def process_reals_lowres(x, lod, mirror_augment, drange_data, drange_net):
+    with tf.name_scope('DynamicRange'):
+        x = tf.cast(x, tf.float32)
+        x = misc.adjust_dynamic_range(x, drange_data, drange_net)
+    if mirror_augment:
+        with tf.name_scope('MirrorAugment'):
             s = tf.shape(x)
-            y = tf.reshape(x, [-1, s[1], s[2]//2, 2, s[3]//2, 2])
-            y = tf.reduce_mean(y, axis=[3, 5], keepdims=True)
-            y = tf.tile(y, [1, 1, 1, 2, 1, 2])
-            y = tf.reshape(y, [-1, s[1], s[2], s[3]])
-            x = tfutil.lerp(x, y, lod - tf.floor(lod))
-        with tf.name_scope('UpscaleLOD'): # Upscale to match the expected input/output size of the networks.
-            s = tf.shape(x)
-            factor = tf.cast(2 ** tf.floor(lod), tf.int32)
-            x = tf.reshape(x, [-1, s[1], s[2], 1, s[3], 1])
-            x = tf.tile(x, [1, 1, 1, factor, 1, factor])
-            x = tf.reshape(x, [-1, s[1], s[2] * factor, s[3] * factor])
-        return x
+            mask = tf.random_uniform([s[0], 1, 1, 1], 0.0, 1.0)
+            mask = tf.tile(mask, [1, s[1], s[2], s[3]])
+            x = tf.where(mask < 0.5, x, tf.reverse(x, axis=[3]))
+    with tf.name_scope('FadeLOD'): # Smooth crossfade between consecutive levels-of-detail.
+        s = tf.shape(x)
+        y = tf.reshape(x, [-1, s[1], s[2]//2, 2, s[3]//2, 2])
+        y = tf.reduce_mean(y, axis=[3, 5], keepdims=True)
+        y = tf.tile(y, [1, 1, 1, 2, 1, 2])
+        y = tf.reshape(y, [-1, s[1], s[2], s[3]])
+        x = tfutil.lerp(x, y, lod - tf.floor(lod))
+    return x
+
+def upscale_reals(x, lod):
+    with tf.name_scope('UpscaleLOD'): # Upscale to match the expected input/output size of the networks.
+        s = tf.shape(x)
+        factor = tf.cast(2 ** tf.floor(lod), tf.int32)
+        x = tf.reshape(x, [-1, s[1], s[2], 1, s[3], 1])
+        x = tf.tile(x, [1, 1, 1, factor, 1, factor])
+        x = tf.reshape(x, [-1, s[1], s[2] * factor, s[3] * factor])
+    return x
 
 #----------------------------------------------------------------------------
 # Class for evaluating and storing the values of time-varying training parameters.
@@ -126,6 +139,89 @@ class TrainingSchedule:
         self.D_lrate = D_lrate_dict.get(self.resolution, D_lrate_base)
         self.tick_kimg = tick_kimg_dict.get(self.resolution, tick_kimg_base)
 
+#----------------------------------------------------------------------------
+# Background thread that keeps up to 'capacity' minibatches staged on the GPUs
+# ahead of the training steps, so that fetching the input and copying it to the
+# device overlaps with the computation. The training loop calls get() before
+# each step that consumes a staged minibatch, and pause()/resume() around
+# reconfiguring the dataset.
+
+class InputStager:
+    def __init__(self, put_ops, clear_ops, capacity=2):
+        self.put_ops        = put_ops
+        self.clear_ops      = clear_ops
+        self.capacity       = capacity
+        self.wait_time      = 0.0       # Total time spent in get(), reset by consume_wait_time().
+        self._sess          = tf.get_default_session()
+        self._cond          = threading.Condition()
+        self._num_staged    = 0         # Minibatches staged but not yet consumed.
+        self._num_pending   = 0         # Minibatches being staged right now.
+        self._paused        = True
+        self._stopped       = False
+        self._exception     = None
+        self._thread        = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (self._paused or self._num_staged + self._num_pending >= self.capacity):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                self._num_pending += 1
+            try:
+                self._sess.run(self.put_ops)
+            except Exception as e:
+                with self._cond:
+                    self._exception = e
+                    self._num_pending -= 1
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._num_pending -= 1
+                self._num_staged += 1
+                self._cond.notify_all()
+
+    # Wait until a minibatch is staged and claim it for the next training step.
+    def get(self):
+        t = time.time()
+        with self._cond:
+            assert not self._paused
+            while self._num_staged == 0 and self._exception is None:
+                self._cond.wait()
+            if self._exception is not None:
+                raise self._exception
+            self._num_staged -= 1
+            self._cond.notify_all()
+        self.wait_time += time.time() - t
+
+    # Stop staging and discard the staged minibatches, e.g. before reconfiguring the dataset.
+    def pause(self):
+        with self._cond:
+            self._paused = True
+            while self._num_pending > 0:
+                self._cond.wait()
+            self._sess.run(self.clear_ops)
+            self._num_staged = 0
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def consume_wait_time(self):
+        t = self.wait_time
+        self.wait_time = 0.0
+        return t
+
 #----------------------------------------------------------------------------
 # Main training script.
 # To run, comment/uncomment appropriate lines in config.py and launch train.py.
@@ -145,7 +241,19 @@ def train_progressive_gan(
     resume_run_id           = None,         # Run ID or network pkl to resume training from, None = start from scratch.
     resume_snapshot         = None,         # Snapshot index to resume training from, None = autodetect.
     resume_kimg             = 0.0,          # Assumed training progress at the beginning. Affects reporting and training schedule.
-    resume_time             = 0.0):         # Assumed wallclock time at the beginning. Affects reporting.
+    resume_time             = 0.0,          # Assumed wallclock time at the beginning. Affects reporting.
+    stage_inputs            = False,        # Prefetch minibatches to the GPUs in a background thread?
+    fuse_train_ops          = False,        # Run the last D step of each iteration and the G step in a single session.run()?
+    process_reals_on_cpu    = False,        # Process reals at dataset resolution on the CPU and transfer them as float16, leaving only the upscale to the GPUs?
+    native_resolution       = False,        # Run G and D at the resolution of the current phase instead of upscaling everything to full resolution?
+    async_snapshots         = False,        # Write network snapshots in a background thread?
+    snapshot_format         = 'pkl',        # Format of network snapshots: 'pkl' = pickle, 'chunked' = memory-mappable chunked format.
+    snapshot_fp16           = False,        # Store weights as float16 in chunked network snapshots?
+    snapshot_keyframe_interval = 0,         # Write every N'th network snapshot in full and the rest as deltas against it, 0 = always full.
+    eval_metrics            = [],           # Metrics to evaluate during training in a separate process, e.g. ['swd', 'fid'], [] = disable.
+    eval_ticks              = 10,           # How often to export Gs for evaluation?
+    eval_num_images         = 10000,        # Number of images to use for each evaluation.
+    eval_gpu                = None):        # CUDA_VISIBLE_DEVICES of the evaluator process, e.g. '1' or '' = CPU only. Required with eval_metrics, must not be a training GPU.
 
     maintenance_start_time = time.time()
     training_set = dataset.load_dataset(data_dir=config.data_dir, verbose=True, **config.dataset)
@@ -166,30 +274,95 @@ def train_progressive_gan(
 
     print('Building TensorFlow graph...')
     with tf.name_scope('Inputs'):
-        lod_in          = tf.placeholder(tf.float32, name='lod_in', shape=[])
-        lrate_in        = tf.placeholder(tf.float32, name='lrate_in', shape=[])
-        minibatch_in    = tf.placeholder(tf.int32, name='minibatch_in', shape=[])
+        if fuse_train_ops: # Set only when the training schedule changes, so that the training ops need no feed_dict.
+            lod_in          = tf.Variable(0.0, name='lod_in', trainable=False)
+            G_lrate_in      = tf.Variable(0.0, name='G_lrate_in', trainable=False)
+            D_lrate_in      = tf.Variable(0.0, name='D_lrate_in', trainable=False)
+            minibatch_in    = tf.Variable(0, name='minibatch_in', trainable=False)
+        else:
+            lod_in          = tf.placeholder(tf.float32, name='lod_in', shape=[])
+            lrate_in        = tf.placeholder(tf.float32, name='lrate_in', shape=[])
+            minibatch_in    = tf.placeholder(tf.int32, name='minibatch_in', shape=[])
+            G_lrate_in      = D_lrate_in = lrate_in
         minibatch_split = minibatch_in // config.num_gpus
         reals, labels   = training_set.get_minibatch_tf()
+        if process_reals_on_cpu:
+            assert fuse_train_ops or not stage_inputs # staged reals are processed without a feed_dict => lod_in must be a variable
+            with tf.name_scope('ProcessReals'), tf.device('/cpu:0'):
+                reals = process_reals_lowres(reals, lod_in, mirror_augment, training_set.dynamic_range, drange_net)
+                reals = tf.cast(reals, tf.float16)
         reals_split     = tf.split(reals, config.num_gpus)
         labels_split    = tf.split(labels, config.num_gpus)
-    G_opt = tfutil.Optimizer(name='TrainG', learning_rate=lrate_in, **config.G_opt)
-    D_opt = tfutil.Optimizer(name='TrainD', learning_rate=lrate_in, **config.D_opt)
+    if stage_inputs:
+        stage_put_ops = []; stage_clear_ops = []
+        for gpu in range(config.num_gpus):
+            with tf.name_scope('GPU%d/StageInputs' % gpu), tf.device('/gpu:%d' % gpu):
+                area = tf.contrib.staging.StagingArea(dtypes=[reals.dtype, labels.dtype])
+                stage_put_ops.append(area.put([reals_split[gpu], labels_split[gpu]]))
+                stage_clear_ops.append(area.clear())
+                staged_reals, staged_labels = area.get()
+                staged_reals.set_shape(reals_split[gpu].shape)
+                staged_labels.set_shape(labels_split[gpu].shape)
+                reals_split[gpu] = staged_reals
+                labels_split[gpu] = staged_labels
+    G_gpus = []; D_gpus = []
     for gpu in range(config.num_gpus):
         with tf.name_scope('GPU%d' % gpu), tf.device('/gpu:%d' % gpu):
-            G_gpu = G if gpu == 0 else G.clone(G.name + '_shadow')
-            D_gpu = D if gpu == 0 else D.clone(D.name + '_shadow')
-            lod_assign_ops = [tf.assign(G_gpu.find_var('lod'), lod_in), tf.assign(D_gpu.find_var('lod'), lod_in)]
-            reals_gpu = process_reals(reals_split[gpu], lod_in, mirror_augment, training_set.dynamic_range, drange_net)
-            labels_gpu = labels_split[gpu]
-            with tf.name_scope('G_loss'), tf.control_dependencies(lod_assign_ops):
-                G_loss = tfutil.call_func_by_name(G=G_gpu, D=D_gpu, opt=G_opt, training_set=training_set, minibatch_size=minibatch_split, **config.G_loss)
-            with tf.name_scope('D_loss'), tf.control_dependencies(lod_assign_ops):
-                D_loss = tfutil.call_func_by_name(G=G_gpu, D=D_gpu, opt=D_opt, training_set=training_set, minibatch_size=minibatch_split, reals=reals_gpu, labels=labels_gpu, **config.D_loss)
-            G_opt.register_gradients(tf.reduce_mean(G_loss), G_gpu.trainables)
-            D_opt.register_gradients(tf.reduce_mean(D_loss), D_gpu.trainables)
-    G_train_op = G_opt.apply_updates()
-    D_train_op = D_opt.apply_updates()
+            G_gpus.append(G if gpu == 0 else G.clone(G.name + '_shadow'))
+            D_gpus.append(D if gpu == 0 else D.clone(D.name + '_shadow'))
+
+    # Build training ops for G and D operating at resolution / 2**native_lod, or at full resolution if native_lod is None.
+    # The optimizers are shared, so that only the loss graph differs between resolution phases.
+    G_opt = tfutil.Optimizer(name='TrainG', learning_rate=G_lrate_in, **config.G_opt)
+    D_opt = tfutil.Optimizer(name='TrainD', learning_rate=D_lrate_in, **config.D_opt)
+    def build_training_ops(native_lod): # => G_train_op, D_train_op
+        loss_kwargs = dict() if native_lod is None else dict(native_lod=native_lod)
+        gpu_lod_assign_ops = []
+        for gpu in range(config.num_gpus):
+            with tf.name_scope('GPU%d' % gpu), tf.device('/gpu:%d' % gpu):
+                G_gpu = G_gpus[gpu]
+                D_gpu = D_gpus[gpu]
+                lod_assign_ops = [tf.assign(G_gpu.find_var('lod'), lod_in), tf.assign(D_gpu.find_var('lod'), lod_in)]
+                if process_reals_on_cpu:
+                    with tf.name_scope('ProcessReals'):
+                        reals_gpu = tf.cast(reals_split[gpu], tf.float32)
+                        if native_lod is None:
+                            reals_gpu = upscale_reals(reals_gpu, lod_in)
+                elif native_lod is None:
+                    reals_gpu = process_reals(reals_split[gpu], lod_in, mirror_augment, training_set.dynamic_range, drange_net)
+                else:
+                    with tf.name_scope('ProcessReals'):
+                        reals_gpu = process_reals_lowres(reals_split[gpu], lod_in, mirror_augment, training_set.dynamic_range, drange_net)
+                labels_gpu = labels_split[gpu]
+                if not fuse_train_ops:
+                    with tf.name_scope('G_loss'), tf.control_dependencies(lod_assign_ops):
+                        G_loss = tfutil.call_func_by_name(G=G_gpu, D=D_gpu, opt=G_opt, training_set=training_set, minibatch_size=minibatch_split, **loss_kwargs, **config.G_loss)
+                with tf.name_scope('D_loss'), tf.control_dependencies(lod_assign_ops):
+                    D_loss = tfutil.call_func_by_name(G=G_gpu, D=D_gpu, opt=D_opt, training_set=training_set, minibatch_size=minibatch_split, reals=reals_gpu, labels=labels_gpu, **loss_kwargs, **config.D_loss)
+                if not fuse_train_ops:
+                    G_opt.register_gradients(tf.reduce_mean(G_loss), G_gpu.trainables)
+                D_opt.register_gradients(tf.reduce_mean(D_loss), D_gpu.trainables)
+                gpu_lod_assign_ops.append(lod_assign_ops)
+        D_train_op = D_opt.apply_updates(drop_disconnected=(native_lod is not None)) # layers above the native resolution are not trained
+        if fuse_train_ops: # G step runs after the D step and Gs update, and sees their results.
+            assert D_repeats >= 1
+            for gpu in range(config.num_gpus):
+                with tf.name_scope('GPU%d' % gpu), tf.device('/gpu:%d' % gpu):
+                    G_gpu = G_gpus[gpu]
+                    D_gpu = D_gpus[gpu]
+                    with tf.name_scope('G_loss'), tf.control_dependencies(gpu_lod_assign_ops[gpu] + [D_train_op, Gs_update_op]), tfutil.ordered_var_reads():
+                        G_loss = tfutil.call_func_by_name(G=G_gpu, D=D_gpu, opt=G_opt, training_set=training_set, minibatch_size=minibatch_split, **loss_kwargs, **config.G_loss)
+                    G_opt.register_gradients(tf.reduce_mean(G_loss), G_gpu.trainables)
+        G_train_op = G_opt.apply_updates(drop_disconnected=(native_lod is not None))
+        return G_train_op, D_train_op
+
+    # One set of training ops per resolution phase in native resolution mode. They are all built
+    # upfront, because autosummaries cannot be added once the first summaries have been saved.
+    if native_resolution:
+        max_lod = int(np.floor(TrainingSchedule(int(resume_kimg * 1000), training_set, **config.sched).lod))
+        training_ops = {native_lod: build_training_ops(native_lod) for native_lod in range(max_lod + 1)}
+    else:
+        training_ops = {None: build_training_ops(None)}
 
     print('Setting up snapshot image grid...')
     grid_size, grid_reals, grid_labels, grid_latents = setup_snapshot_image_grid(G, training_set, **config.grid)
@@ -213,22 +386,66 @@ def train_progressive_gan(
     tick_start_time = time.time()
     train_start_time = tick_start_time - resume_time
     prev_lod = -1.0
+    prev_minibatch = -1
+    prev_inputs = None
+    stager = InputStager(stage_put_ops, stage_clear_ops) if stage_inputs else None
+    snapshot_writer = None
+    if async_snapshots or snapshot_keyframe_interval > 0:
+        snapshot_writer = misc.AsyncSnapshotWriter(snapshot_format, snapshot_fp16, snapshot_keyframe_interval)
+
+    # Start the evaluator process, which picks up the copies of Gs exported to the inbox.
+    # It is a daemon, so that it gets terminated if training fails.
+    evaluator = None
+    if len(eval_metrics):
+        assert eval_gpu is not None, 'eval_metrics requires eval_gpu, the training process already occupies its GPUs'
+        eval_inbox = os.path.join(result_subdir, '_eval-inbox')
+        os.makedirs(eval_inbox, exist_ok=True)
+        eval_writer = misc.AsyncSnapshotWriter()
+        evaluator = multiprocessing.get_context('spawn').Process(target=tfutil.import_obj('util_scripts.evaluate_metrics_live'),
+            kwargs=dict(result_subdir=result_subdir, inbox_dir=eval_inbox, metrics=eval_metrics, num_images=eval_num_images, gpu=eval_gpu), daemon=True)
+        evaluator.start()
+
     while cur_nimg < total_kimg * 1000:
 
         # Choose training parameters and configure training ops.
         sched = TrainingSchedule(cur_nimg, training_set, **config.sched)
+        G_train_op, D_train_op = training_ops[int(np.floor(sched.lod)) if native_resolution else None]
+        reconfigure = (sched.minibatch != prev_minibatch or np.floor(sched.lod) != np.floor(prev_lod))
+        if stager is not None and reconfigure:
+            stager.pause() # staged minibatches no longer match the configuration
         training_set.configure(sched.minibatch, sched.lod)
+        if stager is not None and reconfigure:
+            stager.resume()
         if reset_opt_for_new_lod:
             if np.floor(sched.lod) != np.floor(prev_lod) or np.ceil(sched.lod) != np.ceil(prev_lod):
                 G_opt.reset_optimizer_state(); D_opt.reset_optimizer_state()
         prev_lod = sched.lod
+        prev_minibatch = sched.minibatch
 
         # Run training ops.
-        for repeat in range(minibatch_repeats):
-            for _ in range(D_repeats):
-                tfutil.run([D_train_op, Gs_update_op], {lod_in: sched.lod, lrate_in: sched.D_lrate, minibatch_in: sched.minibatch})
+        if fuse_train_ops:
+            inputs = (sched.lod, sched.G_lrate, sched.D_lrate, sched.minibatch)
+            if inputs != prev_inputs:
+                tfutil.set_vars({lod_in: sched.lod, G_lrate_in: sched.G_lrate, D_lrate_in: sched.D_lrate, minibatch_in: sched.minibatch})
+                prev_inputs = inputs
+            for repeat in range(minibatch_repeats):
+                for _ in range(D_repeats - 1):
+                    if stager is not None:
+                        stager.get()
+                    tfutil.run([D_train_op, Gs_update_op])
+                    cur_nimg += sched.minibatch
+                if stager is not None:
+                    stager.get()
+                tfutil.run([G_train_op]) # includes D_train_op and Gs_update_op
                 cur_nimg += sched.minibatch
-            tfutil.run([G_train_op], {lod_in: sched.lod, lrate_in: sched.G_lrate, minibatch_in: sched.minibatch})
+        else:
+            for repeat in range(minibatch_repeats):
+                for _ in range(D_repeats):
+                    if stager is not None:
+                        stager.get()
+                    tfutil.run([D_train_op, Gs_update_op], {lod_in: sched.lod, lrate_in: sched.D_lrate, minibatch_in: sched.minibatch})
+                    cur_nimg += sched.minibatch
+                tfutil.run([G_train_op], {lod_in: sched.lod, lrate_in: sched.G_lrate, minibatch_in: sched.minibatch})
 
         # Perform maintenance tasks once per tick.
         done = (cur_nimg >= total_kimg * 1000)
@@ -251,7 +468,10 @@ def train_progressive_gan(
                 misc.format_time(tfutil.autosummary('Timing/total_sec', total_time)),
                 tfutil.autosummary('Timing/sec_per_tick', tick_time),
                 tfutil.autosummary('Timing/sec_per_kimg', tick_time / tick_kimg),
-                tfutil.autosummary('Timing/maintenance_sec', maintenance_time)))
+                tfutil.autosummary('Timing/maintenance_sec', maintenance_time)), end='')
+            if stager is not None:
+                print(' input_wait %.1f' % tfutil.autosummary('Timing/input_wait_sec', stager.consume_wait_time()), end='')
+            print()
             tfutil.autosummary('Timing/total_hours', total_time / (60.0 * 60.0))
             tfutil.autosummary('Timing/total_days', total_time / (24.0 * 60.0 * 60.0))
             tfutil.save_summaries(summary_log, cur_nimg)
@@ -261,13 +481,49 @@ def train_progressive_gan(
                 grid_fakes = Gs.run(grid_latents, grid_labels, minibatch_size=sched.minibatch//config.num_gpus)
                 misc.save_image_grid(grid_fakes, os.path.join(result_subdir, 'fakes%06d.png' % (cur_nimg // 1000)), drange=drange_net, grid_size=grid_size)
             if cur_tick % network_snapshot_ticks == 0 or done:
-                misc.save_pkl((G, D, Gs), os.path.join(result_subdir, 'network-snapshot-%06d.pkl' % (cur_nimg // 1000)))
+                network_pkl = os.path.join(result_subdir, 'network-snapshot-%06d.pkl' % (cur_nimg // 1000))
+                if snapshot_writer is not None:
+                    snapshot_writer.save((G, D, Gs), network_pkl)
+                    if not async_snapshots:
+                        snapshot_writer.wait()
+                else:
+                    misc.save_networks((G, D, Gs), network_pkl, snapshot_format, snapshot_fp16)
+            if evaluator is not None and (cur_tick % eval_ticks == 0 or done):
+                if evaluator.is_alive():
+                    eval_writer.wait()
+                    for pkl in glob.glob(os.path.join(eval_inbox, 'Gs-*.pkl')): # not picked up yet => superseded by the new export
+                        try:
+                            os.remove(pkl)
+                        except OSError:
+                            pass
+                    eval_writer.save((Gs,), os.path.join(eval_inbox, 'Gs-%09d.pkl' % cur_nimg))
+                else:
+                    print('Evaluator exited with code %s, no longer exporting Gs.' % evaluator.exitcode)
+                    evaluator = None
+
+            # Warm up the input pipeline for the next training phase before it begins.
+            if hasattr(training_set, 'warmup') and not done:
+                next_sched = TrainingSchedule(cur_nimg + sched.tick_kimg * 1000, training_set, **config.sched)
+                if next_sched.minibatch != sched.minibatch or np.floor(next_sched.lod) != np.floor(sched.lod):
+                    training_set.warmup(next_sched.minibatch, next_sched.lod)
 
             # Record start time of the next tick.
             tick_start_time = time.time()
 
     # Write final results.
-    misc.save_pkl((G, D, Gs), os.path.join(result_subdir, 'network-final.pkl'))
+    if stager is not None:
+        stager.stop()
+    if snapshot_writer is not None:
+        snapshot_writer.save((G, D, Gs), os.path.join(result_subdir, 'network-final.pkl'), allow_delta=False)
+        snapshot_writer.wait()
+    else:
+        misc.save_networks((G, D, Gs), os.path.join(result_subdir, 'network-final.pkl'), snapshot_format, snapshot_fp16)
+    if evaluator is not None:
+        eval_writer.wait()
+        open(os.path.join(eval_inbox, '_stop'), 'wt').close()
+        print('Waiting for the evaluator to finish...')
+        evaluator.join()
+    training_set.close()
     summary_log.close()
     open(os.path.join(result_subdir, '_training-done.txt'), 'wt').close()
 
@@ -8,6 +8,14 @@
 import os
 import time
 import re
+import glob
+import hashlib
+import queue
+import threading
+import json
+import zlib
+import socket
+import multiprocessing
 import bisect
 from collections import OrderedDict
 import numpy as np
@@ -32,7 +40,7 @@ def generate_fake_images(run_id, snapshot=None, grid_size=[1,1], num_pngs=1, ima
     random_state = np.random.RandomState(random_seed)
 
     print('Loading network from "%s"...' % network_pkl)
-    G, D, Gs = misc.load_network_pkl(run_id, snapshot)
+    G, D, Gs = misc.load_network_pkl(run_id, snapshot, names=['Gs'])
 
     result_subdir = misc.create_result_subdir(config.result_dir, config.desc)
     for png_idx in range(num_pngs):
@@ -55,7 +63,7 @@ def generate_interpolation_video(run_id, snapshot=None, grid_size=[1,1], image_s
     random_state = np.random.RandomState(random_seed)
 
     print('Loading network from "%s"...' % network_pkl)
-    G, D, Gs = misc.load_network_pkl(run_id, snapshot)
+    G, D, Gs = misc.load_network_pkl(run_id, snapshot, names=['Gs'])
 
     print('Generating latent vectors...')
     shape = [num_frames, np.prod(grid_size)] + Gs.input_shape[1:] # [frame, image, channel, component]
@@ -134,38 +142,269 @@ def generate_training_video(run_id, duration_sec=20.0, time_warp=1.5, mp4=None,
     open(os.path.join(result_subdir, '_done.txt'), 'wt').close()
 
 #----------------------------------------------------------------------------
-# Evaluate one or more metrics for a previous training run.
-# To run, uncomment one of the appropriate lines in config.py and launch train.py.
+# Persistent cache for the results and real-image statistics of the reals
+# passes in evaluate_metrics(cache_reals=True). Entries live in
+# result_dir/_metric_cache and are keyed by the dataset fingerprint, so that
+# repeated evaluations of any run trained on the same dataset can skip the
+# reals entirely.
 
-def evaluate_metrics(run_id, log, metrics, num_images, real_passes, minibatch_size=None):
-    metric_class_names = {
-        'swd':      'metrics.sliced_wasserstein.API',
-        'fid':      'metrics.frechet_inception_distance.API',
-        'is':       'metrics.inception_score.API',
-        'msssim':   'metrics.ms_ssim.API',
-    }
+def get_dataset_fingerprint(dataset_obj): # covers all files in the dataset directory and the options the dataset was loaded with
+    dataset_dir = getattr(dataset_obj, 'tfrecord_dir', None)
+    files = sorted(glob.glob(os.path.join(dataset_dir, '*'))) if dataset_dir is not None else []
+    stats = [(os.path.basename(f), os.path.getsize(f), int(os.path.getmtime(f))) for f in files if os.path.isfile(f)]
+    load_kwargs = sorted(getattr(dataset_obj, 'load_kwargs', dict()).items())
+    return [None if dataset_dir is None else os.path.abspath(dataset_dir), stats, load_kwargs, type(dataset_obj).__name__, list(dataset_obj.shape), dataset_obj.label_size]
 
-    # Locate training run and initialize logging.
-    result_subdir = misc.locate_result_subdir(run_id)
-    snapshot_pkls = misc.list_network_pkls(result_subdir, include_final=False)
-    assert len(snapshot_pkls) >= 1
-    log_file = os.path.join(result_subdir, log)
-    print('Logging output to', log_file)
-    misc.set_output_log_file(log_file)
+def get_reals_cache_file(fingerprint, num_images, mirror_augment, title, class_name, version):
+    key = repr([fingerprint, num_images, mirror_augment, title, class_name, version])
+    return os.path.join(config.result_dir, '_metric_cache', hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pkl')
 
-    # Initialize dataset and select minibatch size.
-    dataset_obj, mirror_augment = misc.load_dataset_for_previous_run(result_subdir, verbose=True, shuffle_mb=0)
-    if minibatch_size is None:
-        minibatch_size = np.clip(8192 // dataset_obj.shape[1], 4, 256)
+def load_reals_cache(cache_file):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return None
+    return misc.load_pkl(cache_file)
 
-    # Initialize metrics.
+def save_reals_cache(cache_file, entry):
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '%s.%s-%d.tmp' % (cache_file, socket.gethostname(), os.getpid()) # unique, as several processes may fill the same entry
+        misc.save_pkl(entry, tmp_file)
+        os.replace(tmp_file, cache_file)
+
+#----------------------------------------------------------------------------
+# Feeds minibatches to a set of metric objects. With parallel=True, each
+# metric consumes its own bounded queue in a separate thread, so that the
+# producer (image generation or dataset reads) can run ahead while the
+# metrics are busy, and the metrics run concurrently with each other.
+# Metrics that need random numbers use their own RandomState, seeded in
+# begin() on the calling thread, so that the results are reproducible
+# regardless of thread timing. Keeps track of the time spent in each stage.
+
+class MetricFeeder:
+    def __init__(self, names, objs, mode, parallel=False, queue_size=4):
+        self.names      = names
+        self.objs       = objs
+        self.mode       = mode
+        self.parallel   = parallel
+        self.times      = OrderedDict([('wait', 0.0)] + [(name, 0.0) for name in names]) # stage => seconds
+        self._queues    = []
+        self._threads   = []
+        self._exception = None
+        if parallel:
+            for name, obj in zip(names, objs):
+                q = queue.Queue(queue_size)
+                thread = threading.Thread(target=self._run, args=(name, obj, q), daemon=True)
+                thread.start()
+                self._queues.append(q)
+                self._threads.append(thread)
+
+    def add_time(self, stage, seconds): # for the producer stage, listed first
+        if stage not in self.times:
+            self.times[stage] = 0.0
+            self.times.move_to_end(stage, last=False)
+        self.times[stage] += seconds
+
+    def feed(self, images):
+        if not self.parallel:
+            for name, obj in zip(self.names, self.objs):
+                time_begin = time.time()
+                obj.feed(self.mode, images)
+                self.times[name] += time.time() - time_begin
+            return
+        time_begin = time.time()
+        for q in self._queues:
+            q.put(images) # blocks while the metric is too far behind
+        self.times['wait'] += time.time() - time_begin
+        if self._exception is not None:
+            self.close()
+
+    def close(self): # => OrderedDict(stage => seconds)
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._queues = []
+        self._threads = []
+        if self._exception is not None:
+            e, self._exception = self._exception, None
+            raise e
+        return self.times
+
+    def format_times(self):
+        return 'Stage times: ' + ', '.join('%s %s' % (stage, misc.format_time(seconds)) for stage, seconds in self.times.items())
+
+    def _run(self, name, obj, q):
+        while True:
+            images = q.get()
+            if images is None:
+                break
+            if self._exception is not None:
+                continue # keep draining the queue so that the producer does not block
+            time_begin = time.time()
+            try:
+                obj.feed(self.mode, images)
+            except Exception as e:
+                self._exception = e
+            self.times[name] += time.time() - time_begin
+
+#----------------------------------------------------------------------------
+# Work queue for evaluating the snapshots of a run with several processes,
+# possibly on different machines sharing the result directory. A worker
+# claims a snapshot by creating its claim file with O_EXCL, and appends the
+# results to a shared JSON-lines file under a lock file. Snapshots that
+# already have results are skipped, so an interrupted sweep resumes where it
+# stopped. Claims older than claim_timeout are considered abandoned.
+
+class SnapshotWorkQueue:
+    def __init__(self, log_file, key, claim_timeout=6*3600):
+        base = os.path.splitext(log_file)[0]
+        self.claim_dir      = base + '-claims'
+        self.results_file   = base + '-results.jsonl'
+        self.key            = key       # Identifies the metric configuration; results of other configurations are ignored.
+        self.claim_timeout  = claim_timeout
+        self.owner          = '%s %d\n' % (socket.gethostname(), os.getpid()) # Contents of the claim files created by this process.
+        os.makedirs(self.claim_dir, exist_ok=True)
+
+    def claim(self, snapshot_kimg): # => True if the caller should evaluate the snapshot
+        if snapshot_kimg in self.load_results():
+            return False
+        if not self._create_claim('snapshot-%06d.claim' % snapshot_kimg):
+            return False
+        if snapshot_kimg in self.load_results(): # finished by another worker, which released its claim in the meantime
+            self._release_claim('snapshot-%06d.claim' % snapshot_kimg)
+            return False
+        return True
+
+    def claim_table(self, num_snapshots): # => True if the caller should write the final table
+        return self._create_claim('table-%d-%08x.claim' % (num_snapshots, zlib.crc32(self.key.encode('utf-8'))))
+
+    def add_result(self, snapshot_kimg, time_eval, results):
+        append_json_lines(self.results_file, [dict(key=self.key, snapshot_kimg=snapshot_kimg, time_eval=time_eval, results=[[float(val) for val in vals] for vals in results])])
+        self._release_claim('snapshot-%06d.claim' % snapshot_kimg)
+
+    def load_results(self): # => {snapshot_kimg: (time_eval, results), ...}
+        results = dict()
+        for entry in load_json_lines(self.results_file):
+            if entry['key'] == self.key:
+                results[entry['snapshot_kimg']] = (entry['time_eval'], entry['results'])
+        return results
+
+    def _create_claim(self, name):
+        claim_file = os.path.join(self.claim_dir, name)
+        try:
+            if time.time() - os.path.getmtime(claim_file) > self.claim_timeout:
+                os.remove(claim_file)
+        except OSError:
+            pass
+        try:
+            fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.write(fd, self.owner.encode('utf-8'))
+        os.close(fd)
+        return True
+
+    def _release_claim(self, name): # unless another worker has taken it over after a timeout
+        claim_file = os.path.join(self.claim_dir, name)
+        try:
+            with open(claim_file, 'rt') as f:
+                if f.read() != self.owner:
+                    return
+            os.remove(claim_file)
+        except OSError:
+            pass
+
+# Entry point of the worker processes spawned by evaluate_metrics(num_local_workers=N).
+def _evaluate_metrics_worker(kwargs):
+    misc.init_output_logging()
+    np.random.seed(config.random_seed + os.getpid())
+    os.environ.update(config.env)
+    tfutil.init_tf(config.tf_config)
+    evaluate_metrics(**kwargs)
+
+#----------------------------------------------------------------------------
+# Helpers for JSON-lines files shared by several processes.
+
+# Append entries to the file, using a lock file.
+def append_json_lines(filename, entries):
+    lock_file = filename + '.lock'
+    while True:
+        try:
+            os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_file) > 60:
+                    os.remove(lock_file) # left behind by a crashed process
+            except OSError:
+                pass
+            time.sleep(0.1)
+    try:
+        with open(filename, 'at') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+    finally:
+        os.remove(lock_file)
+
+def load_json_lines(filename): # => [entry, ...]
+    entries = []
+    if os.path.isfile(filename):
+        with open(filename, 'rt') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass # partially written by a crashed process
+    return entries
+
+#----------------------------------------------------------------------------
+# Per-run store of metric results in result_subdir/metrics.jsonl, one entry
+# per (snapshot, metric), so that evaluate_metrics() only needs to compute
+# the cells that are missing, e.g. for snapshots written since the last call.
+
+class MetricResultsStore:
+    def __init__(self, result_subdir, num_images, random_seed, metric_kwargs, metric_versions):
+        self.results_file       = os.path.join(result_subdir, 'metrics.jsonl')
+        self.num_images         = num_images
+        self.random_seed        = random_seed
+        self.metric_kwargs      = metric_kwargs
+        self.metric_versions    = metric_versions   # {metric: version}, results of other versions of the metric are ignored
+        self.results            = dict()            # (snapshot_kimg, metric, num_images, random_seed, metric_kwargs, version) => [value, ...]
+        for entry in load_json_lines(self.results_file):
+            key = (entry['snapshot_kimg'], entry['metric'], entry['num_images'], entry['random_seed'], entry['metric_kwargs'], entry.get('version'))
+            self.results[key] = entry['values']
+
+    def get(self, snapshot_kimg, metric): # => [value, ...] or None
+        return self.results.get(self._key(snapshot_kimg, metric))
+
+    def add(self, snapshot_kimg, metrics, results):
+        entries = []
+        for metric, vals in zip(metrics, results):
+            key = self._key(snapshot_kimg, metric)
+            self.results[key] = [float(val) for val in vals]
+            entries.append(dict(snapshot_kimg=key[0], metric=key[1], num_images=key[2], random_seed=key[3], metric_kwargs=key[4], version=key[5], values=self.results[key]))
+        append_json_lines(self.results_file, entries)
+
+    def _key(self, snapshot_kimg, metric):
+        return (snapshot_kimg, metric, self.num_images, self.random_seed, repr(sorted(self.metric_kwargs.get(metric, dict()).items())), self.metric_versions[metric])
+
+#----------------------------------------------------------------------------
+# Building blocks of evaluate_metrics() and evaluate_metrics_live().
+
+metric_class_names = {
+    'swd':      'metrics.sliced_wasserstein.API',
+    'fid':      'metrics.frechet_inception_distance.API',
+    'is':       'metrics.inception_score.API',
+    'msssim':   'metrics.ms_ssim.API',
+}
+
+def init_metrics(metrics, num_images, image_shape, minibatch_size, metric_kwargs=dict()): # => [metric_obj, ...]
     metric_objs = []
     for name in metrics:
         class_name = metric_class_names.get(name, name)
         print('Initializing %s...' % class_name)
         class_def = tfutil.import_obj(class_name)
-        image_shape = [3] + dataset_obj.shape[1:]
-        obj = class_def(num_images=num_images, image_shape=image_shape, image_dtype=np.uint8, minibatch_size=minibatch_size)
+        obj = class_def(num_images=num_images, image_shape=image_shape, image_dtype=np.uint8, minibatch_size=minibatch_size, **metric_kwargs.get(name, dict()))
         tfutil.init_uninited_vars()
         mode = 'warmup'
         obj.begin(mode)
@@ -173,67 +412,284 @@ def evaluate_metrics(run_id, log, metrics, num_images, real_passes, minibatch_si
             obj.feed(mode, np.random.randint(0, 256, size=[minibatch_size]+image_shape, dtype=np.uint8))
         obj.end(mode)
         metric_objs.append(obj)
+    return metric_objs
 
-    # Print table header.
-    print()
-    print('%-10s%-12s' % ('Snapshot', 'Time_eval'), end='')
+# Feed in reals, or load their results and statistics from the cache.
+# Yields (title, time_eval, results, feeder, labels) for each pass.
+def process_reals(dataset_obj, mirror_augment, metrics, metric_objs, num_images, real_passes, minibatch_size, cache_reals=False, metric_kwargs=dict(), parallel_feed=False):
+    fingerprint = get_dataset_fingerprint(dataset_obj) if cache_reals else None
+    num_skipped = 0 # Number of reals consumed by cached passes, to be skipped before the next uncached one.
+    for title, mode in [('Reals', 'reals'), ('Reals2', 'fakes')][:real_passes]:
+        time_begin = time.time()
+        cache_files = [None] * (len(metric_objs) + 1)
+        if cache_reals:
+            cache_files = [get_reals_cache_file(fingerprint, num_images, mirror_augment, title, metric_class_names.get(name, name), [obj.get_reals_version(), sorted(metric_kwargs.get(name, dict()).items())]) for name, obj in zip(metrics, metric_objs)]
+            cache_files.append(get_reals_cache_file(fingerprint, num_images, mirror_augment, title, 'labels', 1))
+        entries = [load_reals_cache(cache_file) for cache_file in cache_files]
+        todo = [idx for idx, entry in enumerate(entries[:-1]) if entry is None]
+        feeder = None
+        if len(todo) or entries[-1] is None:
+            for begin in range(0, num_skipped, minibatch_size):
+                dataset_obj.get_minibatch_np(min(minibatch_size, num_skipped - begin))
+            num_skipped = 0
+            labels = np.zeros([num_images, dataset_obj.label_size], dtype=np.float32)
+            [metric_objs[idx].begin(mode) for idx in todo]
+            feeder = MetricFeeder([metrics[idx] for idx in todo], [metric_objs[idx] for idx in todo], mode, parallel_feed)
+            for begin in range(0, num_images, minibatch_size):
+                end = min(begin + minibatch_size, num_images)
+                time_read = time.time()
+                images, labels[begin:end] = dataset_obj.get_minibatch_np(end - begin)
+                if mirror_augment:
+                    images = misc.apply_mirror_augment(images)
+                if images.shape[1] == 1:
+                    images = np.tile(images, [1, 3, 1, 1]) # grayscale => RGB
+                feeder.add_time('read', time.time() - time_read)
+                feeder.feed(images)
+            feeder.close()
+            for idx in todo:
+                obj = metric_objs[idx]
+                entries[idx] = dict(results=obj.end(mode), reals_state=obj.get_reals_state() if mode == 'reals' else None)
+                save_reals_cache(cache_files[idx], entries[idx])
+            entries[-1] = dict(labels=labels)
+            save_reals_cache(cache_files[-1], entries[-1])
+        else:
+            num_skipped += num_images
+        for idx, obj in enumerate(metric_objs):
+            if idx not in todo and mode == 'reals':
+                obj.set_reals_state(entries[idx]['reals_state'])
+        results = [entry['results'] for entry in entries[:-1]]
+        yield title, time.time() - time_begin, results, feeder, entries[-1]['labels']
+
+# Load the given state into Gs if possible (reuse=True), otherwise construct a new Gs in a new graph and session.
+def load_generator(Gs_state, Gs=None, net_graph=None, net_session=None, reuse=True): # => Gs, net_graph, net_session
+    if reuse and Gs is not None:
+        with net_graph.as_default(), net_session.as_default():
+            if Gs.set_state(Gs_state):
+                return Gs, net_graph, net_session
+    if net_session is not None:
+        net_session.close()
+    net_graph = tf.Graph()
+    with net_graph.as_default():
+        net_session = tfutil.create_session(config.tf_config)
+        with net_session.as_default():
+            Gs = misc.NetworkState(Gs_state).construct()
+    return Gs, net_graph, net_session
+
+# Generate num_images fakes with Gs in the default graph and session, and feed them to the given metrics.
+# With random_seed, the latents and the random numbers of each metric do not depend on the other metrics or on previous calls.
+def evaluate_fakes(Gs, labels, metrics, metric_objs, num_images, minibatch_size, parallel_feed=False, random_seed=None): # => [vals, ...], feeder
+    mode = 'fakes'
+    for obj in metric_objs:
+        if random_seed is not None:
+            np.random.seed(random_seed) # seeds the RandomState of the metric, if any
+        obj.begin(mode)
+    random_state = np.random.RandomState(random_seed) if random_seed is not None else None
+    feeder = MetricFeeder(metrics, metric_objs, mode, parallel_feed)
+    for begin in range(0, num_images, minibatch_size):
+        end = min(begin + minibatch_size, num_images)
+        time_generate = time.time()
+        latents = misc.random_latents(end - begin, Gs, random_state=random_state)
+        images = Gs.run(latents, labels[begin:end], num_gpus=config.num_gpus, out_mul=127.5, out_add=127.5, out_dtype=np.uint8)
+        if images.shape[1] == 1:
+            images = np.tile(images, [1, 3, 1, 1]) # grayscale => RGB
+        feeder.add_time('generate', time.time() - time_generate)
+        feeder.feed(images)
+    feeder.close()
+    return [obj.end(mode) for obj in metric_objs], feeder
+
+def format_metric_header(metric_objs):
+    header = '%-10s%-12s' % ('Snapshot', 'Time_eval')
     for obj in metric_objs:
         for name, fmt in zip(obj.get_metric_names(), obj.get_metric_formatting()):
-            print('%-*s' % (len(fmt % 0), name), end='')
-    print()
-    print('%-10s%-12s' % ('---', '---'), end='')
+            header += '%-*s' % (len(fmt % 0), name)
+    header += '\n%-10s%-12s' % ('---', '---')
     for obj in metric_objs:
         for fmt in obj.get_metric_formatting():
-            print('%-*s' % (len(fmt % 0), '---'), end='')
+            header += '%-*s' % (len(fmt % 0), '---')
+    return header
+
+def format_metric_results(metric_objs, time_eval, results):
+    line = '%-12s' % misc.format_time(time_eval)
+    for obj, vals in zip(metric_objs, results):
+        for val, fmt in zip(vals, obj.get_metric_formatting()):
+            line += fmt % val
+    return line
+
+#----------------------------------------------------------------------------
+# Evaluate one or more metrics for a previous training run.
+# To run, uncomment one of the appropriate lines in config.py and launch train.py.
+
+def evaluate_metrics(run_id, log, metrics, num_images, real_passes, minibatch_size=None, reuse_graph=False, cache_reals=False, metric_kwargs=dict(), parallel_feed=False,
+    sharded=False, claim_timeout=6*3600, num_local_workers=0, store_results=False, random_seed=None):
+
+    # Locate training run and initialize logging.
+    result_subdir = misc.locate_result_subdir(run_id)
+    snapshot_pkls = misc.list_network_pkls(result_subdir, include_final=False)
+    assert len(snapshot_pkls) >= 1
+    log_file = os.path.join(result_subdir, log)
+    worker_log_file = log_file
+    if sharded:
+        worker_log_file = '%s-worker-%s-%d.txt' % (os.path.splitext(log_file)[0], socket.gethostname(), os.getpid())
+    print('Logging output to', worker_log_file)
+    misc.set_output_log_file(worker_log_file)
+
+    # Initialize dataset and select minibatch size.
+    dataset_obj, mirror_augment = misc.load_dataset_for_previous_run(result_subdir, verbose=True, shuffle_mb=0)
+    if minibatch_size is None:
+        minibatch_size = np.clip(8192 // dataset_obj.shape[1], 4, 256)
+
+    # Initialize metrics.
+    metric_objs = init_metrics(metrics, num_images, [3] + dataset_obj.shape[1:], minibatch_size, metric_kwargs)
     print()
+    print(format_metric_header(metric_objs))
 
     # Feed in reals.
-    for title, mode in [('Reals', 'reals'), ('Reals2', 'fakes')][:real_passes]:
-        print('%-10s' % title, end='')
-        time_begin = time.time()
-        labels = np.zeros([num_images, dataset_obj.label_size], dtype=np.float32)
-        [obj.begin(mode) for obj in metric_objs]
-        for begin in range(0, num_images, minibatch_size):
-            end = min(begin + minibatch_size, num_images)
-            images, labels[begin:end] = dataset_obj.get_minibatch_np(end - begin)
-            if mirror_augment:
-                images = misc.apply_mirror_augment(images)
-            if images.shape[1] == 1:
-                images = np.tile(images, [1, 3, 1, 1]) # grayscale => RGB
-            [obj.feed(mode, images) for obj in metric_objs]
-        results = [obj.end(mode) for obj in metric_objs]
-        print('%-12s' % misc.format_time(time.time() - time_begin), end='')
-        for obj, vals in zip(metric_objs, results):
-            for val, fmt in zip(vals, obj.get_metric_formatting()):
-                print(fmt % val, end='')
-        print()
+    # Local workers of a sharded sweep load the reals from the cache, which is filled here before they are spawned.
+    spawn_workers = sharded and num_local_workers > 0
+    reals_rows = []
+    for title, time_eval, results, feeder, labels in process_reals(dataset_obj, mirror_augment, metrics, metric_objs, num_images, real_passes, minibatch_size, cache_reals or spawn_workers, metric_kwargs, parallel_feed):
+        reals_rows.append((title, time_eval, results))
+        print('%-10s' % title + format_metric_results(metric_objs, time_eval, results))
+        if parallel_feed and feeder is not None:
+            print('%-22s%s' % ('', feeder.format_times()))
+    dataset_obj.close()
 
-    # Evaluate each network snapshot.
-    for snapshot_idx, snapshot_pkl in enumerate(reversed(snapshot_pkls)):
-        prefix = 'network-snapshot-'; postfix = '.pkl'
-        snapshot_name = os.path.basename(snapshot_pkl)
-        assert snapshot_name.startswith(prefix) and snapshot_name.endswith(postfix)
-        snapshot_kimg = int(snapshot_name[len(prefix) : -len(postfix)])
+    # Spawn additional local worker processes for a sharded sweep.
+    workers = []
+    if spawn_workers:
+        worker_kwargs = dict(run_id=result_subdir, log=log, metrics=metrics, num_images=num_images, real_passes=real_passes, minibatch_size=minibatch_size,
+            reuse_graph=reuse_graph, cache_reals=True, metric_kwargs=metric_kwargs, parallel_feed=parallel_feed, sharded=True, claim_timeout=claim_timeout,
+            store_results=store_results, random_seed=random_seed)
+        ctx = multiprocessing.get_context('spawn')
+        for idx in range(num_local_workers):
+            workers.append(ctx.Process(target=_evaluate_metrics_worker, args=(worker_kwargs,)))
+            workers[-1].start()
 
+    # Evaluate each network snapshot.
+    # With reuse_graph, Gs is built only once and the variables of subsequent snapshots are
+    # loaded into it, unless their architecture differs.
+    # With sharded, the snapshots are claimed from a work queue shared by all workers.
+    snapshot_kimgs = []
+    for snapshot_pkl in reversed(snapshot_pkls):
+        prefix = 'network-snapshot-'
+        snapshot_name = os.path.splitext(os.path.basename(snapshot_pkl))[0]
+        assert snapshot_name.startswith(prefix)
+        snapshot_kimgs.append(int(snapshot_name[len(prefix):]))
+    work_queue = None
+    if sharded:
+        work_queue = SnapshotWorkQueue(log_file, repr([metrics, num_images, metric_kwargs, random_seed]), claim_timeout)
+    # With store_results, only the metrics that are missing from the results store are computed.
+    # With random_seed, the same latents are used for every snapshot and invocation.
+    # The version of each metric (get_reals_version) is bumped whenever its algorithm changes.
+    store = MetricResultsStore(result_subdir, num_images, random_seed, metric_kwargs, {name: obj.get_reals_version() for name, obj in zip(metrics, metric_objs)}) if store_results else None
+    net_graph = net_session = Gs = None
+    for snapshot_pkl, snapshot_kimg in zip(reversed(snapshot_pkls), snapshot_kimgs):
+        if work_queue is not None and not work_queue.claim(snapshot_kimg):
+            continue
         print('%-10d' % snapshot_kimg, end='')
-        mode ='fakes'
-        [obj.begin(mode) for obj in metric_objs]
         time_begin = time.time()
-        with tf.Graph().as_default(), tfutil.create_session(config.tf_config).as_default():
-            G, D, Gs = misc.load_pkl(snapshot_pkl)
-            for begin in range(0, num_images, minibatch_size):
-                end = min(begin + minibatch_size, num_images)
-                latents = misc.random_latents(end - begin, Gs)
-                images = Gs.run(latents, labels[begin:end], num_gpus=config.num_gpus, out_mul=127.5, out_add=127.5, out_dtype=np.uint8)
-                if images.shape[1] == 1:
-                    images = np.tile(images, [1, 3, 1, 1]) # grayscale => RGB
-                [obj.feed(mode, images) for obj in metric_objs]
-        results = [obj.end(mode) for obj in metric_objs]
-        print('%-12s' % misc.format_time(time.time() - time_begin), end='')
-        for obj, vals in zip(metric_objs, results):
-            for val, fmt in zip(vals, obj.get_metric_formatting()):
-                print(fmt % val, end='')
-        print()
+        results = [None] * len(metric_objs)
+        if store is not None:
+            results = [store.get(snapshot_kimg, name) for name in metrics]
+        todo = [idx for idx, vals in enumerate(results) if vals is None]
+        feeder = None
+        if len(todo):
+            G_state, D_state, Gs_state = misc.load_network_states(snapshot_pkl, names=['Gs'])
+            Gs, net_graph, net_session = load_generator(Gs_state, Gs, net_graph, net_session, reuse_graph)
+            with net_graph.as_default(), net_session.as_default():
+                todo_results, feeder = evaluate_fakes(Gs, labels, [metrics[idx] for idx in todo], [metric_objs[idx] for idx in todo], num_images, minibatch_size, parallel_feed, random_seed)
+            for idx, vals in zip(todo, todo_results):
+                results[idx] = vals
+            if store is not None:
+                store.add(snapshot_kimg, [metrics[idx] for idx in todo], [results[idx] for idx in todo])
+        time_eval = time.time() - time_begin
+        print(format_metric_results(metric_objs, time_eval, results))
+        if parallel_feed and feeder is not None:
+            print('%-22s%s' % ('', feeder.format_times()))
+        if work_queue is not None:
+            work_queue.add_result(snapshot_kimg, time_eval, results)
+    if net_session is not None:
+        net_session.close()
+    print()
+
+    # Once all snapshots of a sharded sweep have been evaluated, the worker that notices writes the full table to the log file.
+    for worker in workers:
+        worker.join()
+    if work_queue is not None:
+        snapshot_results = work_queue.load_results()
+        if all(snapshot_kimg in snapshot_results for snapshot_kimg in snapshot_kimgs) and work_queue.claim_table(len(snapshot_kimgs)):
+            print('Writing results of all workers to', log_file)
+            with open(log_file, 'wt') as f:
+                f.write('\n' + format_metric_header(metric_objs) + '\n')
+                for title, time_eval, results in reals_rows:
+                    f.write('%-10s' % title + format_metric_results(metric_objs, time_eval, results) + '\n')
+                for snapshot_kimg in snapshot_kimgs:
+                    f.write('%-10d' % snapshot_kimg + format_metric_results(metric_objs, *snapshot_results[snapshot_kimg]) + '\n')
+                f.write('\n')
+
+#----------------------------------------------------------------------------
+# Evaluate metrics while a training run is in progress. Runs in a separate
+# process spawned by train.train_progressive_gan(eval_metrics=[...]), which
+# periodically exports Gs to inbox_dir. The reals are processed only once,
+# and the results are written to the tfevents of the run, using a separate
+# event file, as well as to metric-live.txt. Exits once the stop file exists
+# and the inbox is empty.
+
+def evaluate_metrics_live(result_subdir, inbox_dir, metrics, num_images, minibatch_size=None, gpu=None, poll_interval=10.0, metric_kwargs=dict()):
+    misc.init_output_logging()
+    os.environ.update(config.env)
+    if gpu is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    tfutil.init_tf(dict(config.tf_config, **{'gpu_options.allow_growth': True})) # leave the memory of a shared GPU to other processes
+    misc.set_output_log_file(os.path.join(result_subdir, 'metric-live.txt'))
+    parent_pid = os.getppid()
+
+    # Initialize dataset, metrics and reals.
+    dataset_obj, mirror_augment = misc.load_dataset_for_previous_run(result_subdir, verbose=True, shuffle_mb=0)
+    if minibatch_size is None:
+        minibatch_size = np.clip(8192 // dataset_obj.shape[1], 4, 256)
+    metric_objs = init_metrics(metrics, num_images, [3] + dataset_obj.shape[1:], minibatch_size, metric_kwargs)
+    print()
+    print(format_metric_header(metric_objs))
+    for title, time_eval, results, feeder, labels in process_reals(dataset_obj, mirror_augment, metrics, metric_objs, num_images, 1, minibatch_size, metric_kwargs=metric_kwargs):
+        print('%-10s' % title + format_metric_results(metric_objs, time_eval, results))
+    dataset_obj.close()
+
+    # Evaluate exported generators as they arrive.
+    summary_log = tf.summary.FileWriter(result_subdir, filename_suffix='.metrics')
+    stop_file = os.path.join(inbox_dir, '_stop')
+    net_graph = net_session = Gs = None
+    while True:
+        stop = os.path.isfile(stop_file) or os.getppid() != parent_pid # check before listing, so that the final export is not missed
+        pkls = sorted(glob.glob(os.path.join(inbox_dir, 'Gs-*.pkl')))
+        if len(pkls) == 0:
+            if stop:
+                break
+            time.sleep(poll_interval)
+            continue
+        for pkl in pkls:
+            cur_nimg = int(os.path.splitext(os.path.basename(pkl))[0].split('-')[-1])
+            try:
+                os.replace(pkl, pkl + '.busy') # so that training does not remove it as superseded
+            except OSError:
+                continue
+            pkl += '.busy'
+            print('%-10d' % (cur_nimg // 1000), end='')
+            time_begin = time.time()
+            Gs, net_graph, net_session = load_generator(misc.load_network_states(pkl)[0], Gs, net_graph, net_session)
+            with net_graph.as_default(), net_session.as_default():
+                results, feeder = evaluate_fakes(Gs, labels, metrics, metric_objs, num_images, minibatch_size)
+            print(format_metric_results(metric_objs, time.time() - time_begin, results))
+            summary = tf.Summary()
+            for obj, vals in zip(metric_objs, results):
+                for name, val in zip(obj.get_metric_names(), vals):
+                    summary.value.add(tag='Metrics/' + name, simple_value=float(val))
+            summary_log.add_summary(summary, cur_nimg)
+            summary_log.flush()
+            os.remove(pkl)
+    if net_session is not None:
+        net_session.close()
+    summary_log.close()
     print()
 
 #----------------------------------------------------------------------------